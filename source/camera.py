@@ -14,6 +14,7 @@ around a 3D scene.
 from vector import *
 from quaternion import *
 from matrix16 import *
+import numpy as np
 
 WORLD_XAXIS = Vector3(1.0, 0.0, 0.0)
 WORLD_YAXIS = Vector3(0.0, 1.0, 0.0) # World 'UP'
@@ -63,6 +64,12 @@ class Camera():
         self.view = Matrix16()
         self.MVP = Matrix16()
         
+        # Incremented whenever the view or projection changes, renderers
+        # compare it with the version they last uploaded
+        self.version = 0
+        self.versionState = None
+        self.updateVersion()
+        
     def perspective(self, width, height, vFOV, fzNear, fzFar):
         """
         Update the projection matrix
@@ -92,6 +99,7 @@ class Camera():
         
         # Update MVP
         self.MVP = self.projection * self.view
+        self.updateVersion()
     def update(self, dt):
         """
         Update the camera's position and orientation through a physics system
@@ -276,6 +284,7 @@ class Camera():
         # OpenGL uses column major operator on left            Ie: P*V*M*V1 = V2
         # This is the same as row major operator on the right. Ie: V1*M*V*P = V2
         self.MVP = self.view * self.projection
+        self.updateVersion()
         
                            
     def positionUpdateViewMatrix(self):
@@ -289,6 +298,38 @@ class Camera():
         self.view[14] = -(self.zAxis.dot(self.position))
         # Reconstruct the MVP matrix.
         self.MVP = self.view * self.projection
+        self.updateVersion()
+    def updateVersion(self):
+        """
+        Increment the camera version if the view or projection matrix differs
+        from the last version.
+        """
+        state = (list(self.view.elements), list(self.projection.elements))
+        if state != self.versionState:
+            self.versionState = state
+            self.version += 1
+    def getFrustumPlanes(self):
+        """
+        Get the six planes bounding the view frustum in world space as a 6x4
+        array of (a, b, c, d), where a point p is inside a plane if
+        a*p.x + b*p.y + c*p.z + d >= 0. The normals are normalised so d is a
+        distance. The planes are extracted from the rows of the combined
+        projection * view matrix (Gribb & Hartmann).
+        Order: left, right, bottom, top, near, far.
+        """
+        # Matrix16 elements are column major
+        view = np.array(self.view.elements).reshape(4, 4).T
+        projection = np.array(self.projection.elements).reshape(4, 4).T
+        clip = np.dot(projection, view)
+        
+        planes = np.array([ clip[3] + clip[0],
+                            clip[3] - clip[0],
+                            clip[3] + clip[1],
+                            clip[3] - clip[1],
+                            clip[3] + clip[2],
+                            clip[3] - clip[2]])
+        planes /= np.sqrt((planes[:,:3]**2).sum(axis=1))[:,np.newaxis]
+        return planes
     def getInverseProjection(self):
         """
         Get the inverse projection matrix for converting from clip space back to
@@ -299,6 +340,21 @@ class Camera():
                                                     self.FOV, 
                                                     self.fzNear,
                                                     self.fzFar).cvalues()
+    def getInverseView(self):
+        """
+        Get the inverse view matrix for converting from camera space back to
+        world space in the vertex shader. The view matrix is a rotation
+        followed by a translation, so the inverse is the transposed rotation
+        with the camera position as its translation.
+        """
+        inverse = Matrix16()
+        for row in range(3):
+            for column in range(3):
+                inverse[column * 4 + row] = self.view[row * 4 + column]
+        inverse[12] = self.position.x
+        inverse[13] = self.position.y
+        inverse[14] = self.position.z
+        return inverse.cvalues()
     def getModelView(self):
         """ 
         Get the model-viw matrix.
@@ -1,25 +1,205 @@
 from pyglet import *
 from pyglet.gl import *
+from pyglet.gl import gl_info
 
 
 from vector import Vector2, Vector3
 from matrix16 import Matrix16
 
 from utilities import frameBuffer, Pointfield2D, Mesh2DSurface
+from utilities import fullscreenQuadVAO
+from headless import laplacianCaustics
 
+from collections import OrderedDict
 import numpy as np
 import ctypes
 import random
 import shader
 
+class CausticCache():
+    '''
+    A bounded least recently used cache of photon map textures. Each entry is
+    a (texture, framebuffer) pair, evicted entries are reused for new keys so
+    no GL objects are created once the cache is full.
+    '''
+    def __init__(self, size, tileSize, slots):
+        # Both phases of a blend must fit in the cache
+        assert size >= 2
+        self.size = size                # Maximum number of cached textures
+        self.tileSize = tileSize
+        self.slots = slots              # Number of phases cached per period
+        self.entries = OrderedDict()
+        self.free = []
+        
+    def get(self, key):
+        '''
+        Get the entry for key and mark it as recently used, or None.
+        '''
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.entries[key] = entry
+        return entry
+        
+    def put(self, key):
+        '''
+        Get an entry to store the photon map for key in, evicting the least
+        recently used entry if the cache is full.
+        '''
+        if self.free:
+            entry = self.free.pop()
+        elif len(self.entries) >= self.size:
+            entry = self.entries.popitem(last=False)[1]
+        else:
+            texture = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
+                                                         self.tileSize, 
+                                                         self.tileSize,
+                                                         GL_RGBA)
+            entry = (texture, frameBuffer(texture))
+        self.entries[key] = entry
+        return entry
+        
+    def clear(self):
+        self.free.extend(self.entries.values())
+        self.entries.clear()
+
+class CausticArray():
+    '''
+    One period of caustics baked into the layers of a GL_TEXTURE_2D_ARRAY,
+    for scenes whose parameters do not change. The surface shaders (compiled
+    with CAUSTIC_ARRAY defined) interpolate between the two layers either side
+    of the current layer, so no photon maps are drawn at run time.
+    
+    The layers are either rendered with bake or loaded from the images written
+    by Scene.frameGrab (main.py --grab) with load.
+    '''
+    def __init__(self, tileSize, layers):
+        self.tileSize = tileSize
+        self.layers = layers
+        self.layer = 0.0                # Current position within the period
+        self.target = GL_TEXTURE_2D_ARRAY
+        
+        self.id = GLuint()
+        glGenTextures(1, ctypes.byref(self.id))
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+        glTexImage3D(   GL_TEXTURE_2D_ARRAY,
+                        0,
+                        GL_RGBA8,
+                        self.tileSize,
+                        self.tileSize,
+                        self.layers,
+                        0,
+                        GL_RGBA,
+                        GL_UNSIGNED_BYTE,
+                        None)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        
+    def setTime(self, time, period):
+        self.layer = (time % period) / period * self.layers
+        
+    def bake(self, caustics, period):
+        '''
+        Render the photon map of the caustics' surface at each layer's phase
+        of the period into the array. The surface is restored afterwards.
+        '''
+        surface = caustics.surface
+        for layer in range(self.layers):
+            time = period * layer / float(self.layers)
+            surface.heightfield.update(time, surface.verts, surface.v0)
+            surface.upload()
+            caustics.genPhotonMap()
+            # Copy the caustic texture into the layer
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, caustics.pointMapFBO)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+            glCopyTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer,
+                                0, 0, self.tileSize, self.tileSize)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        surface.heightfield.update(surface.time, surface.verts, surface.v0)
+        surface.upload()
+        
+    def load(self, filenames):
+        '''
+        Fill the array from a sequence of tileSize x tileSize images, one per
+        layer.
+        '''
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for layer, filename in enumerate(filenames):
+            frame = image.load(filename).get_image_data()
+            assert frame.width == self.tileSize and \
+                   frame.height == self.tileSize
+            data = frame.get_data('RGBA', self.tileSize * 4)
+            glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer,
+                            self.tileSize, self.tileSize, 1,
+                            GL_RGBA, GL_UNSIGNED_BYTE, data)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
 class Caustics():
+    '''
+    Generates a tileable caustic texture by splatting a photon for each vertex
+    of the surface onto the floor (see shaders/photonmap.vertex).
+    
+    The surface animation repeats every period seconds. If cacheSize is
+    non-zero the period is divided into cacheSlots phases and photon maps are
+    kept in a CausticCache keyed on (phase, light position, depth, photon
+    scale, photon intensity). The photon maps of the two phases either side
+    of the surface time are blended into the caustic texture; a phase which
+    is not cached yet is drawn with the surface moved to that phase, as in
+    CausticArray.bake, and stored. Nothing is done if the key has not
+    changed, e.g. when the scene is paused.
+    
+    By default a photon is drawn for each vertex in the surface's index list.
+    If photonGrid is non-zero a photonGrid x photonGrid grid of photons is
+    drawn instead, with positions and normals interpolated from the surface's
+    vertex buffer on the GPU, so the caustic quality can be tuned without
+    changing the surface resolution. The photons are weighted so that the
+    overall brightness does not depend on the grid size.
+    
+    If triangles is True the surface triangles themselves are projected onto
+    the floor and shaded by the ratio of their area on the surface to their
+    projected area. This gives smooth caustics without the large, heavily
+    overlapping points needed to hide the gaps between photons.
+    
+    If analytic is True no photons are traced. The caustic intensity is
+    approximated from the curvature of the surface, the laplacian of the
+    heights synthesised by the heightfield (see Tessendorf's laplacian
+    option), with headless.laplacianCaustics and uploaded to the caustic
+    texture. This is much cheaper and suits distant views or low end
+    hardware.
+    
+    A resolution greater than one renders the photons into a photon map
+    1/resolution the size of the caustic texture, with the point size scaled
+    to match, and fills the caustic texture with a two pass separable blur of
+    it. This reduces the fill rate of the photon pass and can be changed at
+    run time with setResolution.
+    
+    If spectral is True the photons are drawn by shaders/photonspectral.*,
+    where a geometry shader refracts each photon with the index of refraction
+    of water for red, green and blue light and emits a point per channel.
+    Chromatic caustics then take a single pass over the surface. Contexts
+    older than OpenGL 3.2 have no geometry shaders, the photons are then
+    drawn as usual.
+    '''
     def __init__(self,
                 camera,
                 surface,
                 depth,
                 causticTexture,
                 photonScale=4.0,
-                photonIntensity=2.0):
+                photonIntensity=2.0,
+                period=0.0,
+                cacheSize=0,
+                cacheSlots=64,
+                photonGrid=0,
+                triangles=False,
+                analytic=False,
+                resolution=1,
+                spectral=False):
                   
         self.surface = surface
         self.depth = depth
@@ -30,8 +210,42 @@ class Caustics():
         self.tileSize = self.surface.tileSize
         
         # Compile the shader
-        self.shader = shader.openfiles( 'shaders/photonmap.vertex',
-                                        'shaders/photonmap.fragment')
+        self.photonGrid = photonGrid
+        self.triangles = triangles
+        self.analytic = analytic
+        self.spectral = spectral
+        # The geometry shader needs GLSL 1.50, draw white photons otherwise
+        if self.spectral and not gl_info.have_version(3, 2):
+            print("Spectral caustics need OpenGL 3.2, the context provides " +
+                  gl_info.get_version() + ". Drawing white caustics instead.")
+            self.spectral = False
+        # The photon modes are exclusive
+        assert [bool(self.photonGrid), 
+                self.triangles, 
+                self.spectral].count(True) <= 1
+        # The photon grid reads full vertices from the surface's buffer
+        assert not (self.photonGrid and
+                    (self.surface.compact or self.surface.displacement))
+        if self.photonGrid:
+            defines = ['PHOTON_GRID']
+        elif self.triangles:
+            defines = ['PHOTON_TRIANGLES']
+        else:
+            defines = []
+        if self.surface.compact:
+            defines.append('COMPACT_VERTICES')
+        elif self.surface.displacement:
+            defines.append('TESSENDORF_DISPLACEMENT')
+        if self.spectral:
+            self.shader = shader.openfiles( 'shaders/photonspectral.vertex',
+                                            'shaders/photonspectral.fragment',
+                                            defines,
+                                            geometry=
+                                            'shaders/photonspectral.geometry')
+        else:
+            self.shader = shader.openfiles( 'shaders/photonmap.vertex',
+                                            'shaders/photonmap.fragment',
+                                            defines)
         
         self.causticTexture = causticTexture     
         
@@ -39,14 +253,29 @@ class Caustics():
         self.photonScale = photonScale
         
         # Photon Texture Shader Handles
+        if self.surface.compact:
+            positionName, normalName = "vDisplacement", "vNormalXZ"
+        elif self.surface.displacement:
+            # The normals are derived from the heightfield texture
+            positionName, normalName = "vGridPosition", "vNormal"
+        else:
+            positionName, normalName = "vPosition", "vNormal"
         self.positionHandle = glGetAttribLocation(
                                     self.shader.id,
-                                    "vPosition"
+                                    positionName
                                 )
         self.normalHandle = glGetAttribLocation(
                                     self.shader.id,
-                                    "vNormal"
+                                    normalName
                                 )                                        
+        self.gridScaleHandle = glGetUniformLocation(
+                                    self.shader.id,
+                                    "gridScale"
+                                )
+        self.heightsHandle = glGetUniformLocation(
+                                    self.shader.id,
+                                    "heights"
+                                )
         self.lightPositionHandle = glGetUniformLocation(
                                     self.shader.id,
                                     "vLightPosition"
@@ -67,72 +296,168 @@ class Caustics():
                                     self.shader.id,
                                     "photonScale"
                                 )
+        self.surfaceVerticesHandle = glGetUniformLocation(
+                                    self.shader.id,
+                                    "surfaceVertices"
+                                )
+        self.photonGridHandle = glGetUniformLocation(
+                                    self.shader.id,
+                                    "photonGrid"
+                                )
+        self.tileShiftHandle = glGetUniformLocation(
+                                    self.shader.id,
+                                    "tileShift"
+                                )
                                 
         # Get a framebuffer object
         self.pointMapFBO = frameBuffer(self.causticTexture)
                 
         self.setupVAO()
         
+        # Reduced resolution photon map
+        self.blurShader = None
+        self.lowResFBO = None
+        self.setResolution(resolution)
+        
+        # Photon map cache
+        self.period = period
+        if cacheSize and self.period:
+            self.cache = CausticCache(cacheSize, self.tileSize, cacheSlots)
+            self.cacheState = None
+            self.blendShader = shader.openfiles('shaders/passthru.vertex',
+                                                'shaders/causticblend.fragment')
+            self.blendLowerHandle = glGetUniformLocation(self.blendShader.id,
+                                                         "lower")
+            self.blendUpperHandle = glGetUniformLocation(self.blendShader.id,
+                                                         "upper")
+            self.blendHandle = glGetUniformLocation(self.blendShader.id,
+                                                    "blend")
+            self.blendVAO, self.blendIndexCount = fullscreenQuadVAO(
+                glGetAttribLocation(self.blendShader.id, "vPosition"),
+                glGetAttribLocation(self.blendShader.id, "vTexCoord"))
+        else:
+            self.cache = None
+        
     def setupVAO(self):
         '''
-        Perform initial setup for this object's vertex array object, which
-        stores the vertex VBO and indices VBO. This is used to draw the surface
-        geometry for computing caustics in the shader.
+        Perform initial setup for this object's vertex array object. The
+        surface's vertex and index VBOs are shared rather than copied, so the
+        surface geometry for computing caustics in the shader is uploaded once
+        per frame by Surface.update.
         '''
         # Vertex Array Object for Position and Normal VBOs
         self.VAO = GLuint()
         glGenVertexArrays(1,ctypes.pointer(self.VAO))
         glBindVertexArray(self.VAO)
         
-        # Vertex Buffer Objects (Positions Normals and Indices)
-        self.vertVBO = GLuint()
-        self.indexVBO = GLuint()
-        glGenBuffers(1, ctypes.pointer(self.vertVBO))
-        glGenBuffers(1, ctypes.pointer(self.indexVBO))
-                
-        indicesGL = np.ctypeslib.as_ctypes(self.surface.indices)
-        vertsGL = np.ctypeslib.as_ctypes(self.surface.verts)
-        vertexSize = ctypes.sizeof(GLfloat) * 8
-        offsetNormals = ctypes.sizeof(GLfloat) * 3
-        offsetTexture = ctypes.sizeof(GLfloat) * 6
-
-        # Set up vertices VBO (associated with VAO)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)      
-        glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(vertsGL), vertsGL, GL_STATIC_DRAW)
-        # Positions
-        glEnableVertexAttribArray(self.positionHandle) 
-        glVertexAttribPointer(self.positionHandle, 3, GL_FLOAT, GL_FALSE, vertexSize, 0)
-        # Normals
-        glEnableVertexAttribArray(self.normalHandle) 
-        glVertexAttribPointer(self.normalHandle, 3, GL_FLOAT, GL_FALSE, vertexSize, offsetNormals)
-
-        # Set up indices VBO (associated with VAO)
-        # Indices
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexVBO)      
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, ctypes.sizeof(indicesGL), indicesGL, GL_STATIC_DRAW)
+        if self.photonGrid:
+            # The photon grid fetches the surface from a buffer texture
+            self.vertexTexture = GLuint()
+            glGenTextures(1, ctypes.byref(self.vertexTexture))
+            glBindTexture(GL_TEXTURE_BUFFER, self.vertexTexture)
+            glTexBuffer(GL_TEXTURE_BUFFER, GL_R32F, self.surface.vertVBO)
+            glBindTexture(GL_TEXTURE_BUFFER, 0)
+        else:
+            self.surface.bindVertexAttributes(  self.positionHandle,
+                                                self.normalHandle)
 
         glBindVertexArray(0)
         
         
+    def setResolution(self, resolution):
+        '''
+        Set the divisor of the photon map resolution, 1 renders the photons
+        directly into the caustic texture.
+        '''
+        self.resolution = resolution
+        if self.lowResFBO:
+            glDeleteFramebuffers(1, ctypes.byref(self.lowResFBO))
+            glDeleteFramebuffers(1, ctypes.byref(self.blurFBO))
+            self.lowResFBO = None
+        if self.resolution == 1:
+            return
+            
+        size = self.tileSize // self.resolution
+        self.lowResTexture = self.createTexture(size, size)
+        self.lowResFBO = frameBuffer(self.lowResTexture)
+        # The horizontal pass upsamples the rows only
+        self.blurTexture = self.createTexture(self.tileSize, size)
+        self.blurFBO = frameBuffer(self.blurTexture)
+        
+        if not self.blurShader:
+            self.blurShader = shader.openfiles( 'shaders/passthru.vertex',
+                                                'shaders/causticblur.fragment')
+            self.blurTextureHandle = glGetUniformLocation(self.blurShader.id,
+                                                          "texture")
+            self.blurDirectionHandle = glGetUniformLocation(
+                                                        self.blurShader.id,
+                                                        "direction")
+            self.blurVAO, self.blurIndexCount = fullscreenQuadVAO(
+                glGetAttribLocation(self.blurShader.id, "vPosition"),
+                glGetAttribLocation(self.blurShader.id, "vTexCoord"))
+        
+    def createTexture(self, width, height):
+        '''
+        Create a tileable texture for an intermediate photon map.
+        '''
+        texture = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
+                                                     width, 
+                                                     height,
+                                                     GL_RGBA)
+        glBindTexture(GL_TEXTURE_2D, texture.id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        return texture
+        
+    def upsample(self):
+        '''
+        Blur the reduced resolution photon map into the caustic texture, first
+        along the rows into the intermediate texture, then along the columns.
+        '''
+        size = self.tileSize // self.resolution
+        glUseProgram(self.blurShader.id)
+        glUniform1i(self.blurTextureHandle, 0)
+        glActiveTexture(GL_TEXTURE0)
+        glBindVertexArray(self.blurVAO)
+        
+        passes = [  (self.lowResTexture, self.blurFBO, size, (1.0 / size, 0.0)),
+                    (self.blurTexture, self.pointMapFBO, self.tileSize,
+                     (0.0, 1.0 / size))]
+        for source, target, height, direction in passes:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, target)
+            glViewport(0, 0, self.tileSize, height)
+            glBindTexture(GL_TEXTURE_2D, source.id)
+            glUniform2f(self.blurDirectionHandle, *direction)
+            glDrawElements( GL_TRIANGLES,
+                            self.blurIndexCount,
+                            GL_UNSIGNED_SHORT,
+                            0)
+        
+        # Unbind texture, quad, shader and FBO
+        glBindVertexArray(0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glUseProgram(0)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        
     def genPhotonMap(self):
         '''
         Bind and draw surface geometry using the photon shader and output
-        the pixels to the caustic texture via a framebuffer.
+        the pixels to the caustic texture via a framebuffer. The surface must
+        have been updated first as its vertex buffer is drawn as-is.
         '''                
-        # Update the vertex VBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)
-        
-        glBufferData(GL_ARRAY_BUFFER, 
-                     self.surface.verts.size*4, 
-                     np.ctypeslib.as_ctypes(self.surface.verts),
-                     GL_STATIC_DRAW)
-        
         # Bind FBO A/B to set Texture A/B as the output texture
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.pointMapFBO)
+        size = self.tileSize // self.resolution
+        if self.resolution > 1:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.lowResFBO)
+        else:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.pointMapFBO)
             
         # Set the viewport to the size of the texture 
         # (we are going to render to texture)
-        glViewport(0,0, self.tileSize, self.tileSize)
+        glViewport(0,0, size, size)
             
         # Clear the output texture
         glClearColor(0.0, 0.0, 0.0 ,1.0)
@@ -144,32 +469,201 @@ class Caustics():
         glUniform3f(self.lightPositionHandle, *self.lightPosition.cvalues())
         glUniform1f(self.depthHandle, self.depth)
         glUniform1f(self.sizeHandle, self.tileSize)    
-        glUniform1f(self.photonIntensityHandle, self.photonIntensity)
-        glUniform1f(self.photonScaleHandle, self.photonScale)
+        glUniform1f(self.gridScaleHandle, self.surface.scale)
+        if self.triangles:
+            # The triangle brightness does not depend on the resolution
+            glUniform1f(self.photonScaleHandle, self.photonScale)
+        else:
+            glUniform1f(self.photonScaleHandle, 
+                        max(self.photonScale / self.resolution, 1.0))
         glDisable(GL_DEPTH_TEST)
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE)
         
         glBindVertexArray(self.VAO)
-        glDrawElements(GL_POINTS, self.surface.vertexCount, GL_UNSIGNED_INT, 0)            
+        if self.surface.displacement:
+            # The surface grid is displaced by the heightfield's texture
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_2D, self.surface.heightfield.getTexture().id)
+            glUniform1i(self.heightsHandle, 0)
+        if self.photonGrid:
+            # Spread the light of one photon per index over the grid
+            photons = self.photonGrid * self.photonGrid
+            glUniform1f(self.photonIntensityHandle, self.photonIntensity * 
+                        self.surface.vertexCount / float(photons))
+            glUniform1i(self.photonGridHandle, self.photonGrid)
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_BUFFER, self.vertexTexture)
+            glUniform1i(self.surfaceVerticesHandle, 0)
+            glDrawArrays(GL_POINTS, 0, photons)
+            glBindTexture(GL_TEXTURE_BUFFER, 0)
+        elif self.triangles:
+            glUniform1f(self.photonIntensityHandle, self.photonIntensity)
+            # Draw the mesh shifted onto each neighbouring tile so that the
+            # triangles which cross the edges of the tile wrap around
+            for shiftX in (-1.0, 0.0, 1.0):
+                for shiftZ in (-1.0, 0.0, 1.0):
+                    glUniform2f(self.tileShiftHandle, shiftX, shiftZ)
+                    glDrawElements( GL_TRIANGLES,
+                                    self.surface.vertexCount,
+                                    GL_UNSIGNED_INT,
+                                    0)
+        else:
+            glUniform1f(self.photonIntensityHandle, self.photonIntensity)
+            glDrawElements(GL_POINTS, self.surface.vertexCount, GL_UNSIGNED_INT, 0)            
 
         # Unbind shader and FBO
+        glBindTexture(GL_TEXTURE_2D, 0)
         glBindVertexArray(0)
         glUseProgram(0)   
         glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)  
         
         glDisable(GL_BLEND)
+        if self.resolution > 1:
+            self.upsample()
         glEnable(GL_DEPTH_TEST)
         glClearColor(0.0, 0.49, 1.0 ,1.0)
         # Restore viewport
         glViewport(0, 0, self.camera.width, self.camera.height)
     
+    def genLaplacianMap(self):
+        '''
+        Approximate the caustics from the laplacian of the surface heights
+        and upload them to the caustic texture.
+        '''
+        laplacian = self.surface.heightfield.laplacianMap
+        caustics = laplacianCaustics(laplacian,
+                                     self.depth,
+                                     self.photonScale,
+                                     self.photonIntensity)
+        
+        texels = np.empty(laplacian.shape + (4,), np.uint8)
+        texels[..., 0:3] = (caustics * 255.0)[..., np.newaxis]
+        texels[..., 3] = 255
+        
+        glBindTexture(GL_TEXTURE_2D, self.causticTexture.id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0,
+                        self.tileSize, self.tileSize,
+                        GL_RGBA, GL_UNSIGNED_BYTE,
+                        np.ctypeslib.as_ctypes(texels))
+        glBindTexture(GL_TEXTURE_2D, 0)
+        
+    def blendPhotonMaps(self, lower, upper, blend):
+        '''
+        Fill the caustic texture by blending two cached photon maps.
+        '''
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.pointMapFBO)
+        glViewport(0,0, self.tileSize, self.tileSize)
+        glDisable(GL_DEPTH_TEST)
+        
+        glUseProgram(self.blendShader.id)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, lower[0].id)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_2D, upper[0].id)
+        glUniform1i(self.blendLowerHandle, 0)
+        glUniform1i(self.blendUpperHandle, 1)
+        glUniform1f(self.blendHandle, blend)
+        
+        glBindVertexArray(self.blendVAO)
+        glDrawElements(GL_TRIANGLES, self.blendIndexCount, GL_UNSIGNED_SHORT, 0)
+        
+        # Unbind textures, quad, shader and FBO
+        glBindVertexArray(0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glUseProgram(0)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        
+        glEnable(GL_DEPTH_TEST)
+        # Restore viewport
+        glViewport(0, 0, self.camera.width, self.camera.height)
+        
+    def storePhotonMap(self, entry):
+        '''
+        Copy the caustic texture into a cache entry.
+        '''
+        glBindFramebufferEXT(GL_READ_FRAMEBUFFER_EXT, self.pointMapFBO)
+        glBindFramebufferEXT(GL_DRAW_FRAMEBUFFER_EXT, entry[1])
+        glBlitFramebufferEXT(0, 0, self.tileSize, self.tileSize,
+                             0, 0, self.tileSize, self.tileSize,
+                             GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        
+    def cachePhotonMap(self, slot, key):
+        '''
+        Draw the photon map at the phase of a cache slot and store it under
+        key. The surface is left at that phase.
+        '''
+        surface = self.surface
+        time = self.period * slot / float(self.cache.slots)
+        surface.heightfield.update(time, surface.verts, surface.v0)
+        surface.upload()
+        self.genPhotonMap()
+        entry = self.cache.put(key)
+        self.storePhotonMap(entry)
+        return entry
+        
     def update(self, dt):
         '''
         Regenerate the caustic texture using the surface normals, only needs
         calling if the surface normals or light position has changed.
         '''
-        self.genPhotonMap()
+        if self.analytic:
+            self.genLaplacianMap()
+            return
+        if not self.cache:
+            self.genPhotonMap()
+            return
+            
+        slots = self.cache.slots
+        phase = (self.surface.time % self.period) / self.period * slots
+        parameters = (  self.lightPosition.x,
+                        self.lightPosition.y,
+                        self.lightPosition.z,
+                        self.depth,
+                        self.photonScale,
+                        self.photonIntensity,
+                        self.photonGrid,
+                        self.resolution)
+        state = (phase, parameters)
+        if state == self.cacheState:
+            return
+        self.cacheState = state
+        
+        lowerKey = (int(phase) % slots,) + parameters
+        upperKey = ((int(phase) + 1) % slots,) + parameters
+        lower = self.cache.get(lowerKey)
+        upper = self.cache.get(upperKey)
+        if not (lower and upper):
+            if not lower:
+                lower = self.cachePhotonMap(lowerKey[0], lowerKey)
+            if not upper:
+                # The keys are equal if there is a single slot
+                upper = self.cache.get(upperKey) or \
+                        self.cachePhotonMap(upperKey[0], upperKey)
+            # Restore the surface
+            surface = self.surface
+            surface.heightfield.update(surface.time, surface.verts, surface.v0)
+            surface.upload()
+        self.blendPhotonMaps(lower, upper, phase - int(phase))
+                
+    def setPhotonGrid(self, photonGrid):
+        '''
+        Change the size of the photon grid, only available if the caustics
+        were created with a photon grid.
+        '''
+        assert self.photonGrid and photonGrid > 0
+        self.photonGrid = photonGrid
+        
+    def clearCache(self):
+        '''
+        Discard the cached photon maps, required when the surface has changed.
+        '''
+        if self.cache:
+            self.cache.clear()
+            self.cacheState = None
         
     def setDepth(self, depth):
         '''
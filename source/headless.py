@@ -0,0 +1,445 @@
+__author__ = "Peter Bennett"
+__copyright__ = "Copyright 2013, Peter A Bennett"
+__license__ = "LGPL"
+__maintainer__ = "Peter Bennett"
+__email__ = "pab850@gmail.com"
+__contact__ = "www.bytebash.com"
+
+'''
+NumPy implementations of the GPU engines. These do not require an OpenGL
+context so they can be run on machines without a GPU, profiled on the CPU and
+used as a reference when checking the output of the shaders.
+'''
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+# Constants shared with shaders/ripples.fragment
+kEPSILON = 2.0 ** -8                    # Heights below this are set to zero
+kDamping = 1.0 - (10.0 * 2.0 ** -8)     # Damping applied on each step
+kTapRadius = 0.05                       # Radius of a tap in texture space
+kTapHeight = 257.0                      # Height set by a tap
+kHeightScale = 1.0 / 64.0               # Texture height to vertex height
+kMaxTaps = 32                           # Taps applied by a single step
+kBlockSize = 32                         # Block size for sparse simulation
+
+# Constants shared with shaders/photonmap.vertex
+kEta = 1.0 / 1.333                      # Refractive index of air over water
+
+# Smallest area a patch of the surface is focused into by the analytic
+# caustics, relative to its area on the surface
+kMinFocus = 0.25
+
+class StepClock():
+    '''
+    Converts the time passed to a heightfield's update function into a number
+    of automaton steps to run in that frame.
+    
+    With a stepRate of zero, substeps steps are run every frame. Otherwise
+    steps are run at stepRate steps per second of elapsed time so that the
+    wave speed does not depend on the frame rate; no more than substeps steps
+    are run in one frame and any backlog beyond that is dropped.
+    '''
+    def __init__(self, substeps=1, stepRate=0.0):
+        self.substeps = substeps
+        self.stepRate = stepRate
+        self.time = None
+        self.pending = 0.0
+        
+    def steps(self, time):
+        if not self.stepRate:
+            return self.substeps
+        if self.time is None:
+            self.time = time
+        self.pending += (time - self.time) * self.stepRate
+        self.time = time
+        steps = int(self.pending)
+        if steps > self.substeps:
+            steps = self.substeps
+            self.pending = 0.0
+        else:
+            self.pending -= steps
+        return steps
+
+class ActiveBlocks():
+    '''
+    Tracks which blockSize x blockSize blocks of an NxN automaton need to be
+    stepped, so that the cost of a sparse simulation scales with the activity
+    on the surface rather than its area.
+    
+    A block is woken when a tap lands in it or any of its eight neighbours,
+    or when the readback shows energy (heights above kEPSILON) in it or any
+    of its eight neighbours, and stays awake for
+    the next 'hold' steps. Blocks that are asleep are zero in every state
+    buffer, so hold must allow for the readback latency and for the three
+    buffer rotation to write zeros into all of the buffers.
+    '''
+    def __init__(self, dimension, blockSize=kBlockSize, hold=3):
+        self.N = dimension
+        self.blockSize = blockSize
+        self.hold = hold
+        self.count = (self.N + self.blockSize - 1) // self.blockSize
+        # Remaining steps for which each block is stepped
+        self.awake = np.zeros((self.count, self.count), int)
+        
+    def mark(self, x, y, radius=0.0):
+        '''
+        Wake the blocks covering a circle at (x, y) in texture space and their
+        neighbours. Waves move one texel per step so, as long as no more than
+        blockSize steps are run per update, the neighbours hold everything
+        the tap reaches before the next measure.
+        '''
+        x0, x1 = [int(min(max(c * self.N, 0), self.N - 1)) // self.blockSize
+                  for c in (x - radius, x + radius)]
+        y0, y1 = [int(min(max(c * self.N, 0), self.N - 1)) // self.blockSize
+                  for c in (y - radius, y + radius)]
+        self.awake[max(y0 - 1, 0):y1 + 2, max(x0 - 1, 0):x1 + 2] = self.hold
+        
+    def measure(self, nonzero, rects):
+        '''
+        Wake the blocks around any block which holds energy. nonzero is an NxN
+        boolean array of texels with non-zero heights, only the texels inside
+        rects (which must be aligned to blocks) are up to date.
+        '''
+        B = self.blockSize
+        energy = np.zeros((self.count, self.count), bool)
+        for x, y, w, h in rects:
+            region = nonzero[y:y + h, x:x + w]
+            rows = (region.shape[0] + B - 1) // B
+            cols = (region.shape[1] + B - 1) // B
+            padded = np.zeros((rows * B, cols * B), bool)
+            padded[:region.shape[0], :region.shape[1]] = region
+            energy[y // B:y // B + rows, x // B:x // B + cols] = \
+                padded.reshape(rows, B, cols, B).any(axis=(1, 3))
+        # Dilate by one block in every direction
+        dilated = energy.copy()
+        dilated[1:, :] |= energy[:-1, :]
+        dilated[:-1, :] |= energy[1:, :]
+        grown = dilated.copy()
+        grown[:, 1:] |= dilated[:, :-1]
+        grown[:, :-1] |= dilated[:, 1:]
+        self.awake[grown] = self.hold
+        
+    def advance(self, steps):
+        '''
+        Count down the blocks that have just been stepped.
+        '''
+        np.maximum(self.awake - steps, 0, out=self.awake)
+        
+    def rects(self):
+        '''
+        Get the awake blocks as a list of (x, y, width, height) texel
+        rectangles, neighbouring blocks on a row are merged into one.
+        '''
+        B = self.blockSize
+        rects = []
+        for row in range(self.count):
+            awake = self.awake[row] > 0
+            col = 0
+            while col < self.count:
+                if not awake[col]:
+                    col += 1
+                    continue
+                start = col
+                while col < self.count and awake[col]:
+                    col += 1
+                x, y = start * B, row * B
+                rects.append((x, y, min(col * B, self.N) - x,
+                              min(y + B, self.N) - y))
+        return rects
+
+class RipplesCPU():
+    '''
+    A CPU implementation of the ripple automaton computed by the Ripples
+    heightfield generator in shaders/ripples.fragment. It provides the same
+    update and tap interface so that it can be used in place of Ripples.
+
+    The same three buffer rotation as the GPU version is used, each step
+    writes the buffer holding the oldest state:
+
+        new = damping * (sum(neighbours(previous)) / 2 - current)
+
+    Heights with a magnitude at or below kEPSILON are set to zero and the
+    outermost row and column on each side are held at zero.
+    
+    The number of steps run by each update is set by substeps and stepRate
+    (see StepClock). Taps are queued and up to kMaxTaps of them are applied
+    by each step.
+
+    If blockSize is non-zero only the blocks with recent activity (see
+    ActiveBlocks) are stepped and copied into the vertex array.
+    
+    If threads is greater than one, the rows of each step are split into
+    bands which are computed in parallel (NumPy releases the GIL for the
+    array arithmetic). In sparse mode the active regions are computed in
+    parallel instead.
+    '''
+    def __init__(self, 
+                 dimension=64,
+                 threads=1,
+                 substeps=1,
+                 stepRate=0.0,
+                 blockSize=0):
+        self.N = dimension              # Dimension - should be power of 2
+        self.threads = threads
+        self.clock = StepClock(substeps, stepRate)
+        
+        # Sparse simulation, blocks stay awake for long enough to be checked
+        # for energy on the following update
+        if blockSize:
+            self.blocks = ActiveBlocks(self.N, blockSize, 3 + 2 * substeps)
+        else:
+            self.blocks = None
+
+        # Automaton state buffers, self.current indexes the latest state
+        self.states = [np.zeros((self.N, self.N), np.float32)
+                       for i in range(3)]
+        self.current = 0
+
+        # Texel centres in texture space, used to rasterise taps
+        centres = (np.arange(self.N, dtype=np.float32) + 0.5) / self.N
+        self.u, self.v = np.meshgrid(centres, centres)
+
+        # Queue of tap positions in texture space
+        self.taps = []
+
+        # Bands of rows to be stepped in parallel when the simulation is dense
+        if self.threads > 1:
+            self.pool = ThreadPool(self.threads)
+        else:
+            self.pool = None
+        edges = np.linspace(0, self.N, max(self.threads, 1) + 1).astype(int)
+        self.bands = [(0, a, self.N, b - a) 
+                      for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+    def update(self, time, verts, v0):
+        '''
+        Advance the automaton and apply the heights to the Y component of the
+        vertex array.
+        '''
+        steps = self.clock.steps(time)
+        if not steps:
+            return
+        if self.blocks:
+            rects = self.blocks.rects()
+            self.blocks.advance(steps)
+        else:
+            rects = self.bands
+        for i in range(steps):
+            self.step(rects)
+            
+        heights = self.getHeights()
+        for x, y, w, h in rects:
+            verts[y:y + h, x:x + w, 1] = heights[y:y + h, x:x + w] * kHeightScale
+        if self.blocks:
+            self.blocks.measure(heights != 0.0, rects)
+
+    def getHeights(self):
+        '''
+        Get the latest state of the automaton as an NxN array.
+        '''
+        return self.states[self.current]
+
+    def tap(self, tapPosition):
+        x = tapPosition.x / float(self.N)
+        y = tapPosition.y / float(self.N)
+        self.taps.append((x, y))
+        if self.blocks:
+            self.blocks.mark(x, y, kTapRadius)
+
+    def step(self, rects):
+        '''
+        Advance the automaton by one step, only the texels inside rects are
+        computed.
+        '''
+        output = (self.current + 1) % 3
+
+        if self.pool:
+            self.pool.map(self.stepRect, rects)
+        else:
+            for rect in rects:
+                self.stepRect(rect)
+
+        if self.taps:
+            taps = np.array(self.taps[:kMaxTaps], np.float32)
+            del self.taps[:kMaxTaps]
+            du = self.u[..., np.newaxis] - taps[:, 0]
+            dv = self.v[..., np.newaxis] - taps[:, 1]
+            inside = (du ** 2 + dv ** 2 < kTapRadius ** 2).any(axis=-1)
+            self.states[output][inside] = kTapHeight
+
+        self.current = output
+
+    def stepRect(self, rect):
+        '''
+        Compute the texels of the next state inside rect (x, y, width,
+        height). Only the output buffer is written so non-overlapping
+        rectangles may be computed concurrently.
+        '''
+        x, y, w, h = rect
+        previous = self.states[self.current]
+        current = self.states[(self.current + 2) % 3]
+        output = self.states[(self.current + 1) % 3]
+        
+        # The edges of the pool are held at zero
+        output[y:y + h, x:x + w] = 0.0
+        
+        # Interior texels inside the rectangle
+        top, bottom = max(y, 1), min(y + h, self.N - 1)
+        left, right = max(x, 1), min(x + w, self.N - 1)
+        if top >= bottom or left >= right:
+            return
+
+        result = output[top:bottom, left:right]
+        # Neighbour average from the previous state (x-1, x+1, y-1, y+1)
+        np.add(previous[top:bottom, left - 1:right - 1],
+               previous[top:bottom, left + 1:right + 1], out=result)
+        result += previous[top - 1:bottom - 1, left:right]
+        result += previous[top + 1:bottom + 1, left:right]
+        result *= 0.5
+        result -= current[top:bottom, left:right]
+        # Apply damping
+        result *= kDamping
+        # If velocity AND height are almost zero, set it to zero.
+        result[np.abs(result) <= kEPSILON] = 0.0
+
+class CausticsCPU():
+    '''
+    A CPU implementation of the photon map generated by Caustics using
+    shaders/photonmap.vertex, for baking caustics without a GL context and as
+    a reference for the GPU path.
+
+    Every vertex of the surface emits a photon: the direction to the light is
+    refracted through the vertex normal and intersected with the floor at
+    depth. The intersection is wrapped around to the tile as in the shader and
+    a photonScale x photonScale point of photonIntensity / 256 is added to the
+    tileSize x tileSize photon map. As the GPU draws the points through the
+    surface's triangle index list, each vertex is weighted by the number of
+    times it appears in indices.
+
+    The photon map holds the values written to the caustic texture, clamped to
+    [0, 1] but not quantised to 8 bits. Row z, column x of the map is texel
+    (x, z) of the texture.
+
+    If threads is greater than one the vertices are split into chunks which
+    are processed in parallel and the resulting maps summed.
+    '''
+    def __init__(self,
+                 tileSize,
+                 depth,
+                 photonScale=4.0,
+                 photonIntensity=2.0,
+                 lightPosition=(0.0, 5000.0, 0.0),
+                 threads=1):
+        self.tileSize = tileSize
+        self.depth = depth
+        self.photonScale = photonScale
+        self.photonIntensity = photonIntensity
+        self.lightPosition = np.array(lightPosition, np.float32)
+        self.threads = threads
+        if self.threads > 1:
+            self.pool = ThreadPool(self.threads)
+        else:
+            self.pool = None
+        self.photonMap = np.zeros((self.tileSize, self.tileSize), np.float32)
+
+    def setDepth(self, depth):
+        self.depth = depth
+
+    def update(self, verts, indices=None):
+        '''
+        Regenerate the photon map from a surface vertex array (see
+        Surface.verts) and its index list, returns the photon map.
+        '''
+        positions = verts[..., 0:3].reshape(-1, 3).astype(np.float32)
+        normals = verts[..., 3:6].reshape(-1, 3).astype(np.float32)
+        if indices is None:
+            weights = np.ones(len(positions), np.float32)
+        else:
+            weights = np.bincount(np.ravel(indices),
+                                  minlength=len(positions)).astype(np.float32)
+
+        chunks = [(positions[a:b], normals[a:b], weights[a:b]) for a, b in
+                  self.chunks(len(positions))]
+        if self.pool:
+            maps = self.pool.map(self.photons, chunks)
+        else:
+            maps = [self.photons(chunk) for chunk in chunks]
+
+        photonMap = np.sum(maps, axis=0)
+        photonMap *= self.photonIntensity / 256.0
+        np.clip(photonMap, 0.0, 1.0, out=photonMap)
+        self.photonMap = photonMap.astype(np.float32)
+        return self.photonMap
+
+    def chunks(self, count):
+        edges = np.linspace(0, count, max(self.threads, 1) + 1).astype(int)
+        return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+    def photons(self, chunk):
+        '''
+        Count the photons from a chunk of (positions, normals, weights) that
+        land on each texel of the photon map.
+        '''
+        positions, normals, weights = chunk
+        N = self.tileSize
+
+        position = positions.copy()
+        position[:, 0] += 0.5
+        position[:, 2] += 0.5
+
+        # Light direction refracted through the surface normal, as GLSL refract
+        light = self.lightPosition - position
+        light /= np.linalg.norm(light, axis=1)[:, np.newaxis]
+        normal = normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+        eta = kEta
+        cosine = np.sum(normal * light, axis=1)
+        k = 1.0 - eta * eta * (1.0 - cosine * cosine)
+        refracted = eta * light - \
+            (eta * cosine + np.sqrt(np.maximum(k, 0.0)))[:, np.newaxis] * normal
+        refracted[k < 0.0] = 0.0
+
+        # Intersect with the floor, wrapping around to the tile
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = (self.depth - position[:, 1]) / refracted[:, 1]
+            intercept = (position + refracted * distance[:, np.newaxis]) / N
+        valid = np.isfinite(intercept).all(axis=1)
+        x = np.mod(intercept[valid, 0], 1.0) * N
+        z = np.mod(intercept[valid, 2], 1.0) * N
+        weights = weights[valid]
+
+        # Rasterise each photon as a square point, clipped to the map
+        size = max(int(round(self.photonScale)), 1)
+        x0 = np.floor(x - size / 2.0 + 0.5).astype(int)
+        z0 = np.floor(z - size / 2.0 + 0.5).astype(int)
+        counts = np.zeros(N * N, np.float32)
+        for dz in range(size):
+            row = z0 + dz
+            for dx in range(size):
+                column = x0 + dx
+                inside = (row >= 0) & (row < N) & (column >= 0) & (column < N)
+                counts += np.bincount(row[inside] * N + column[inside],
+                                      weights[inside], N * N)
+        return counts.reshape(N, N)
+
+def laplacianCaustics(laplacian, depth, photonScale=4.0, photonIntensity=2.0):
+    '''
+    Approximate the photon map of Caustics from the laplacian L of the surface
+    heights instead of tracing photons, see Caustics' analytic option.
+    
+    L is in world units (per quad squared, as synthesised by Tessendorf's
+    laplacian option) and depth is the distance to the floor in world units.
+    The photon shader moves each photon by depth * (1 + kEta) times the slope
+    of the surface, so a small patch of the surface lights
+    J = 1 - depth * (1 + kEta) * L times its own area of the floor and its
+    brightness is 1 / J. Past the focus (J below kMinFocus) the photons are
+    spread over several folds and the brightness is capped. Every photon lands
+    on the tile, so the map is scaled to the mean brightness of a flat surface
+    before it is clamped to [0, 1] like the photon map.
+    '''
+    # Each vertex appears six times in the surface's index list
+    flat = 6.0 * photonScale ** 2 * photonIntensity / 256.0
+    focus = 1.0 - depth * (1.0 + kEta) * laplacian
+    brightness = 1.0 / np.maximum(focus, kMinFocus)
+    brightness *= flat / brightness.mean()
+    return np.clip(brightness, 0.0, 1.0).astype(np.float32)
@@ -6,22 +6,39 @@ __email__ = "pab850@gmail.com"
 __contact__ = "www.bytebash.com"
 
 from utilities import *
+from pyglet.gl import gl_info
+
+import shader
+from headless import StepClock, ActiveBlocks, kMaxTaps, kTapRadius
 
 from math import *
 import numpy as np
 from vector import Vector2, Vector3
 
-from ctypes import pointer, sizeof
+from ctypes import pointer, sizeof, memmove
 
 class Tessendorf():
+    '''
+    Ocean waves synthesised with FFTs as described in Tessendorf's
+    "Simulating Ocean Water".
+    
+    By default update writes the displaced positions and normals into the
+    surface vertices. If texture is True the vertices are left alone and the
+    displacements (x, height, z) are uploaded into an N x N RGBA float
+    texture instead, see getTexture. The surface (displacement=True) and the
+    caustics then displace their static grids on the GPU.
+    '''
     def __init__(self, 
                  dimension=64, 
                  A=0.0005,
                  w=Vector2(32.0, 32.0),
                  length=64,
-                 period=200.0):
+                 period=200.0,
+                 laplacian=False,
+                 texture=False):
 
         self.N = dimension              # Dimension - should be power of 2
+        self.laplacian = laplacian      # Also synthesise the laplacian of h
         
         self.N1 = self.N+1              # Vertex grid has additional row and
                                         # column for tiling purposes
@@ -49,6 +66,8 @@ class Tessendorf():
         self.hTildeSlopeZ = np2DArray(0.0+0j,self.N,self.N) # NormalZ @ t
         self.hTildeDx = np2DArray(0.0+0j,self.N,self.N)     # DisplacementX @ t
         self.hTildeDz = np2DArray(0.0+0j,self.N,self.N)     # DisplacementZ @ t
+        self.hTildeLaplacian = np2DArray(0.0+0j,self.N,self.N) # Laplacian @ t
+        self.laplacianMap = np.zeros((self.N, self.N), np.float32)
         
         # Lookup tables for code optimisation
         self.dispersionLUT = np2DArray(0.0, self.N, self.N) # Dispersion Lookup
@@ -72,6 +91,31 @@ class Tessendorf():
                 self.dispersionLUT[i][j] = self.dispersion(j, i) 
                 # Build a length LUT
                 self.lenLUT[i][j] = sqrt(kx * kx + kz * kz)
+                
+        # Vertex (i, j) of the N+1 x N+1 grid samples the heightfield at
+        # (i % N, j % N) so that the tiles join seamlessly
+        wrap = np.arange(self.N1) % self.N
+        self.wrap = np.ix_(wrap, wrap)
+        
+        # Largest displacement from the grid along each axis
+        self.maxDisplacement = np.zeros(3, np.float32)
+        
+        # GPU displacement
+        if texture:
+            self.displacementMap = np.zeros((self.N, self.N, 4), np.float32)
+            self.texture = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
+                                                              self.N, 
+                                                              self.N,
+                                                              GL_RGBA32F)
+            # Vertices sample texel centres, the texture repeats like the waves
+            glBindTexture(GL_TEXTURE_2D, self.texture.id)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+            glBindTexture(GL_TEXTURE_2D, 0)
+        else:
+            self.texture = None
         
     def phillips(self, nPrime, mPrime):
         '''
@@ -135,6 +179,10 @@ class Tessendorf():
         self.hTildeSlopeX = self.hTilde * self.kxLUT * 1j
         self.hTildeSlopeZ = self.hTilde * self.kzLUT * 1j
         
+        # Laplacian of the heights, the second derivatives multiply by -k**2
+        if self.laplacian:
+            self.hTildeLaplacian = self.hTilde * -(self.lenLUT ** 2)
+        
         # Generate a set of indices for which the length in the length 
         # look-up table is less than 0.000001
         zeros = self.lenLUT < 0.000001
@@ -163,27 +211,19 @@ class Tessendorf():
         # Normals
         self.hTildeSlopeX = np.fft.fft2(self.hTildeSlopeX)
         self.hTildeSlopeZ = np.fft.fft2(self.hTildeSlopeZ)
+        # Curvature
+        if self.laplacian:
+            self.hTildeLaplacian = np.fft.fft2(self.hTildeLaplacian)
          
     def evaluateWavesFFT(self, t):
         self.genHTilde(t)
         self.doFFT()
          
-    def update(self, time, verts, v0):
+    def evaluate(self, time):
         '''
-        Update the input vertex arrays
-        # Vertex arrays are 3-dimensional have have the following structure:
-        [
-         [[v0x,v0y,v0z,n0x,n0y,n0z],[v1x,v1y,v1z,n1x,n1y,n1z]],
-         [[v2x,v2y,v2z,n2x,n2y,n2z],[v3x,v3y,v3z,n3x,n3y,n3z]],
-         [[v4x,v4y,v4z,n4x,n4y,n4z],[v5x,v5y,v5z,n5x,n5y,n5z]]
-        ]
-        Positions and normals are sampled from the heightfield and applied to
-        the input array.
-        verts: input array to be modified
-        v0: the original vertex positions
+        Synthesise the heights, displacements and slopes for the given time,
+        and the largest displacement along each axis.
         '''
-        
-        # First, do a surface update
         self.evaluateWavesFFT(time)
 
         # Apply -1**x, -1**z factors
@@ -198,57 +238,66 @@ class Tessendorf():
         self.hTildeDx[1::2,1::2] = -self.hTildeDx[1::2,1::2]
         self.hTildeDz[::2,::2] = -self.hTildeDz[::2,::2]
         self.hTildeDz[1::2,1::2] = -self.hTildeDz[1::2,1::2]
+        if self.laplacian:
+            self.hTildeLaplacian = -self.hTildeLaplacian
+            self.hTildeLaplacian[::2,::2] = -self.hTildeLaplacian[::2,::2]
+            self.hTildeLaplacian[1::2,1::2] = -self.hTildeLaplacian[1::2,1::2]
+            self.laplacianMap = self.hTildeLaplacian.real.astype(np.float32)
+        self.maxDisplacement = np.array([np.abs(self.hTildeDx.real).max(),
+                                         np.abs(self.hTilde.real).max(),
+                                         np.abs(self.hTildeDz.real).max()],
+                                        np.float32)
+            
+    def getTexture(self):
+        '''
+        Get the texture holding the latest displacements (x, height, z) of the
+        heightfield, texel (x, z) displaces vertex (x, z) of the grid. Only
+        available if the heightfield was created with texture=True.
+        '''
+        return self.texture
+         
+    def update(self, time, verts, v0):
+        '''
+        Update the input vertex arrays
+        # Vertex arrays are 3-dimensional have have the following structure:
+        [
+         [[v0x,v0y,v0z,n0x,n0y,n0z],[v1x,v1y,v1z,n1x,n1y,n1z]],
+         [[v2x,v2y,v2z,n2x,n2y,n2z],[v3x,v3y,v3z,n3x,n3y,n3z]],
+         [[v4x,v4y,v4z,n4x,n4y,n4z],[v5x,v5y,v5z,n5x,n5y,n5z]]
+        ]
+        Positions and normals are sampled from the heightfield and applied to
+        the input array.
+        verts: input array to be modified
+        v0: the original vertex positions
+        
+        If the heightfield has a texture the displacements are uploaded to it
+        instead and the vertex arrays are not modified.
+        '''
+        
+        # First, do a surface update
+        self.evaluate(time)
+        
+        if self.texture:
+            self.displacementMap[...,0] = -self.hTildeDx.real
+            self.displacementMap[...,1] = self.hTilde.real
+            self.displacementMap[...,2] = -self.hTildeDz.real
+            glBindTexture(GL_TEXTURE_2D, self.texture.id)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.N, self.N,
+                            GL_RGBA, GL_FLOAT,
+                            np.ctypeslib.as_ctypes(self.displacementMap))
+            glBindTexture(GL_TEXTURE_2D, 0)
+            return
                            
-        # Update the vertex list for all elements apart from max indices
+        # Update the vertex list, the last row and column repeat the first
+        # to allow seamless tiling
         # Position X,Y,Z
-        verts[:self.N:,:self.N:,0] = v0[:self.N:,:self.N:,0] + self.hTildeDx * -1
-        verts[:self.N:,:self.N:,1] = self.hTilde
-        verts[:self.N:,:self.N:,2] = v0[:self.N:,:self.N:,2]  + self.hTildeDz * -1
+        verts[...,0] = v0[...,0] - self.hTildeDx.real[self.wrap]
+        verts[...,1] = self.hTilde.real[self.wrap]
+        verts[...,2] = v0[...,2] - self.hTildeDz.real[self.wrap]
         # Normal X,Y,Z
-        verts[:self.N:,:self.N:,3] = -self.hTildeSlopeX
-        verts[:self.N:,:self.N:,4] = 1.0
-        verts[:self.N:,:self.N:,5] = -self.hTildeSlopeZ
-        
-        # Allow seamless tiling:
-
-        # Top index of vertices - reference bottom index of displacement array
-        # vertices(N,N) = original(N,N) + hTilde(0,0) * - 1
-        # Position X,Y,Z
-        verts[self.N,self.N,0] = v0[self.N,self.N,0] + \
-                                      self.hTildeDx[0,0] * -1                         
-        verts[self.N,self.N,1] = self.hTilde[0,0]
-        verts[self.N,self.N,2] = v0[self.N,self.N,2] + \
-                                      self.hTildeDz[0,0] * -1
-        # Normal X,Y,Z                    
-        verts[self.N,self.N,3] = -self.hTildeSlopeX[0,0]
-        verts[self.N,self.N,4] = 1.0
-        verts[self.N,self.N,5] = -self.hTildeSlopeZ[0,0]
-        
-        # Last row of vertices - Reference first row of the displacement array
-        # vertices(N,[0..N]) = original(N,[0..N]) + hTilde(0,[0..N]) * -1
-        # Position X,Y,Z
-        verts[self.N,0:self.N:,0] = v0[self.N,0:self.N:,0] + \
-                                         self.hTildeDx[0,0:self.N:] * -1                        
-        verts[self.N,0:self.N:,1] = self.hTilde[0,0:self.N:]
-        verts[self.N,0:self.N:,2] = v0[self.N,0:self.N:,2] + \
-                                         self.hTildeDz[0,0:self.N:] * -1
-        # Normal X,Y,Z                          
-        verts[self.N,0:self.N:,3] = -self.hTildeSlopeX[0,0:self.N:]
-        verts[self.N,0:self.N:,4] = 1.0
-        verts[self.N,0:self.N:,5] = -self.hTildeSlopeZ[0,0:self.N:]
-        
-        # Last col of vertices - Reference first col of the displacement array
-        # vertices([0..N],N) = original([0..N],N) + hTilde([0..N],0) * -1
-        # Position X,Y,Z
-        verts[0:self.N:,self.N,0] = v0[0:self.N:,self.N,0] + \
-                                         self.hTildeDx[0:self.N:,0] * -1 
-        verts[0:self.N:,self.N,1] = self.hTilde[0:self.N:,0]
-        verts[0:self.N:,self.N,2] = v0[0:self.N:,self.N,2] + \
-                                         self.hTildeDz[0:self.N:,0] * -1
-        # Normal X,Y,Z                          
-        verts[0:self.N:,self.N,3] = -self.hTildeSlopeX[0:self.N:,0]
-        verts[0:self.N:,self.N,4] = 1.0
-        verts[0:self.N:,self.N,5] = -self.hTildeSlopeZ[0:self.N:,0]
+        verts[...,3] = -self.hTildeSlopeX.real[self.wrap]
+        verts[...,4] = 1.0
+        verts[...,5] = -self.hTildeSlopeZ.real[self.wrap]
 
         
 class Ripples():
@@ -260,69 +309,103 @@ class Ripples():
     
     This heightfield generator makes use of the GPU to compute the ripples:
     
-    FBO ping-pong buffers are required, three buffers are used in
-    the following fashion:
+    Each step of the automaton needs the previous state (for the neighbour
+    average) and the state before that (the 'current' value at each texel).
+    Three textures are rotated so that the output of a step is never one of
+    its inputs and no copy pass is needed:
+    
+        Step n:     T[(n-1)%3], T[(n-2)%3] ----> Shader ----> T[n%3]
+        
+     T0 -+                T1 -+                T2 -+
+         +--> Shader --> T2   +--> Shader --> T0   +--> Shader --> T1 .. Repeat
+     T1 -+        |      T2 -+        |      T0 -+        |
+                  +--> Display        +--> Display        +--> Display
+    
+    The display texture (the output of the latest step) is used to displace
+    the heightfield vertices.
     
-    Buffer A,B = PingPong Buffers
-    Buffer C = CurrentBuffer (Lets us read a snapshot of the current destination
-                              buffer as it is written)
+    Reading the display texture back to the CPU with glGetTexImage stalls
+    until the GPU has finished rendering it. Setting readbackLatency to 1 or 2
+    instead reads the texture asynchronously into a ring of pixel buffer
+    objects; the heights applied to the vertices are then that many frames
+    old, but the GPU and the Python thread are no longer serialised:
     
-                               A = Cycle - 1         B = Cycle - 1     
-                               C = Current           C = Current
-                     
-     B ----> Shader -+--> A --+-> Shader -+--> B --+-> Shader -+--> A  .. Repeat
-                     |        |           |        |           |
-                     +--> C --+           +--> C --+           +--> C
-                          |                    |                    |
-                          +-----> Display      +-----> Display      +--> Display
+        Frame n:    glReadPixels -> PBO[n % ring]   (asynchronous)
+                    map PBO[(n - latency) % ring]   (if its fence signalled)
+                    
+    Heights are stored in single channel float textures (heightFormat of 
+    GL_R32F or GL_R16F) when the context supports them. Otherwise, or if
+    heightFormat is GL_RGBA, they are packed into RGBA8 textures as follows:
     
-    The display texture is used to displace the heightfield vertices.
+        Channel R maps to the values 0 - 1 in steps of 2**-8
+        Channel G maps to the values 1 - 256 in steps of 1
+        Channel B denotes the sign of the pixel
+        
+    Several steps may be run per frame (see headless.StepClock for the
+    substeps and stepRate parameters), they are issued back-to-back with no
+    readback in between. Taps are queued and uploaded as a uniform array so
+    that up to kMaxTaps of them are applied in a single step.
+    
+    If blockSize is non-zero the simulation is sparse: only blocks with recent
+    activity (see headless.ActiveBlocks) are stepped, using scissored passes,
+    and only those blocks are read back and decoded into the vertices.
+    
+    With cpuReadback disabled nothing is read back and the vertex array is
+    left untouched; the surface is then expected to displace its vertices in
+    the vertex shader by sampling getTexture() (see Surface). heightAt can
+    still be used for occasional queries of the heightfield. The sparse
+    simulation relies on the readback so blockSize is ignored in this mode.
+    The heights are not bounded, so maxDisplacement is None and a surface
+    displaced by them cannot be culled.
     '''
     
-    def __init__(self, camera, dimension=64):
+    def __init__(self,
+                 camera,
+                 dimension=64,
+                 readbackLatency=2,
+                 heightFormat=GL_R32F,
+                 substeps=1,
+                 stepRate=0.0,
+                 blockSize=0,
+                 cpuReadback=True):
     
         self.N = dimension              # Dimension - should be power of 2
         self.camera = camera
-
-        # Set up vertices for rendering a fullscreen quad
-        self.vertices, self.indices, self.vertexSize = fullscreenQuad()
-        
-        # Vertex Buffer Objects (Positions Texcoords and Indices)
-        self.vertVBO = GLuint()
-        self.indexVBO = GLuint()
-        glGenBuffers(1, pointer(self.vertVBO))
-        glGenBuffers(1, pointer(self.indexVBO))       
-        self.offsetTexcoords = sizeof(GLfloat) * 3
-        
-       
-        self.tapPosition = Vector2(0.0,0.0)
+        self.clock = StepClock(substeps, stepRate)
+        self.cpuReadback = cpuReadback
+        self.maxDisplacement = None     # Heights are not bounded
+        
+        # Sparse simulation, blocks stay awake until a readback taken after
+        # they have settled has been collected
+        if blockSize and self.cpuReadback:
+            hold = 3 + 2 * substeps * (readbackLatency + 1)
+            self.blocks = ActiveBlocks(self.N, blockSize, hold)
+        else:
+            self.blocks = None
+        self.fullRect = [(0, 0, self.N, self.N)]
+        
+        # Fall back to packed RGBA8 heights if float textures are unavailable
+        if heightFormat != GL_RGBA and not (gl_info.have_version(3, 0) or
+                (gl_info.have_extension('GL_ARB_texture_float') and
+                 gl_info.have_extension('GL_ARB_texture_rg'))):
+            heightFormat = GL_RGBA
+        self.heightFormat = heightFormat
+        self.floatHeights = self.heightFormat != GL_RGBA
+        defines = ['MAX_TAPS %d' % kMaxTaps]
+        if self.floatHeights:
+            defines.append('FLOAT_HEIGHTS')
+            self.readFormat = (GL_RED, GL_FLOAT)
+        else:
+            self.readFormat = (GL_RGBA, GL_UNSIGNED_BYTE)
 
         self.rippleShader = shader.openfiles(   'shaders/ripples.vertex',
-                                                'shaders/ripples.fragment')
-                                                
-        self.copyShader = shader.openfiles(   'shaders/passthru.vertex',
-                                                'shaders/passthru.fragment')
+                                                'shaders/ripples.fragment',
+                                                defines)
                                         
-        self.textureA = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
-                                                        self.N, 
-                                                        self.N,
-                                                        GL_RGBA)
-                                                        
-        self.textureB = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
-                                                        self.N, 
-                                                        self.N,
-                                                        GL_RGBA)
-                                                        
-        self.textureC = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
-                                                        self.N, 
-                                                        self.N,
-                                                        GL_RGBA)
-                                         
-        self.frameBufferA = frameBuffer(self.textureA)
-        self.frameBufferB = frameBuffer(self.textureB)
-        self.frameBufferC = frameBuffer(self.textureC)
-        
-        self.mBufferSelect = False
+        # Automaton state textures, self.current indexes the latest state
+        self.textures = [self.createTexture() for i in range(3)]
+        self.frameBuffers = [frameBuffer(texture) for texture in self.textures]
+        self.current = 0
 
         # Shader handles (water ripple shader)
         self.rippleTextureHandle = glGetUniformLocation(
@@ -333,216 +416,296 @@ class Ripples():
                                                         self.rippleShader.id,
                                                         "currentTexture")
                                         
-        self.rippleTapPosHandle = glGetUniformLocation(
+        self.rippleTapsHandle = glGetUniformLocation(
+                                                        self.rippleShader.id,
+                                                        "taps")
+        self.rippleTapCountHandle = glGetUniformLocation(
                                                         self.rippleShader.id,
-                                                        "tapPos")
-        self.rippleTapHandle = glGetUniformLocation(
+                                                        "tapCount")
+        self.ripplePixelSizeHandle = glGetUniformLocation(
                                                         self.rippleShader.id,
-                                                        "tapped")
+                                                        "pixelSize")
         
 
         self.ripplePositionHandle = glGetAttribLocation(self.rippleShader.id,
                                                         "vPosition")
         self.rippleTexcoordHandle = glGetAttribLocation(self.rippleShader.id,
                                                         "vTexCoord")
+                                                        
+        # The fullscreen quad never changes, upload it once
+        self.VAO, self.indexCount = fullscreenQuadVAO(
+                                                self.ripplePositionHandle,
+                                                self.rippleTexcoordHandle)
         
-        # Shader handles (passthru copy shader)
-        self.copyTextureHandle = glGetUniformLocation(  self.copyShader.id,
-                                                        "texture")
-        self.copyPositionHandle = glGetAttribLocation(  self.copyShader.id,
-                                                        "vPosition")
-        self.copyTexcoordHandle = glGetAttribLocation(  self.copyShader.id,
-                                                        "vTexCoord")
-        
-        # Ripple shader variables
-        self.tapped = False
+        # Queue of tap positions in texture space
+        self.taps = []
                 
         # Texbuffer
-        self.buffer = (GLubyte * (self.N * self.N * 4))()
+        if self.floatHeights:
+            self.buffer = (GLfloat * (self.N * self.N))()
+        else:
+            self.buffer = (GLubyte * (self.N * self.N * 4))()
+        
+        # Pixel buffer ring for asynchronous readback, a latency of zero uses
+        # a synchronous glReadPixels instead.
+        self.readbackLatency = readbackLatency
+        self.readbackFrame = 0
+        self.pixelBuffers = (GLuint * (self.readbackLatency + 1))()
+        self.fences = [None] * len(self.pixelBuffers)
+        self.pendingRects = [None] * len(self.pixelBuffers)
+        if self.readbackLatency:
+            glGenBuffers(len(self.pixelBuffers), self.pixelBuffers)
+            for pixelBuffer in self.pixelBuffers:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffer)
+                glBufferData(   GL_PIXEL_PACK_BUFFER,
+                                sizeof(self.buffer),
+                                None,
+                                GL_STREAM_READ)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
 
     def update(self, time, verts, v0):          
 
-        if self.mBufferSelect:
-            self.renderToFBO(self.frameBufferA, 
-                        self.textureA, 
-                        self.textureB)
+        steps = self.clock.steps(time)
+        if not steps:
+            return
+        if self.blocks:
+            rects = self.blocks.rects()
+            self.blocks.advance(steps)
         else:
-            self.renderToFBO(self.frameBufferB, 
-                        self.textureB, 
-                        self.textureA)
-   
-        self.mBufferSelect = not self.mBufferSelect
-        
-        # Use the values in textureC to update the vertices
-        glBindTexture(GL_TEXTURE_2D, self.textureC.id)      
-        glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_UNSIGNED_BYTE, self.buffer)
+            rects = self.fullRect
+        self.simulate(steps, rects)
+        
+        # Use the values in the latest state texture to update the vertices
+        if not self.cpuReadback:
+            rects = []
+        elif self.readbackLatency:
+            rects = self.readbackAsync(rects)
+        else:
+            self.readback(rects, self.buffer)
+        if rects:
+            self.decode(verts, rects)
         
-        # Channel R maps to the values 0 - 1 in steps of 2**-8
-        # Channel G maps to the values 1 - 256 in steps of 1
-        # Channel B denotes the sign of the pixel, where 0.0 is positive and 1.0 is negative.
-        R = np.array(self.buffer[0::4]).reshape(self.N,self.N)
-        G = np.array(self.buffer[1::4]).reshape(self.N,self.N)
-        B = np.array(self.buffer[2::4]).reshape(self.N,self.N)
+        # Restore viewport
+        glViewport(0, 0, self.camera.width, self.camera.height)
         
-        negatives = B >= 1.0
+    def getTexture(self):
+        '''
+        Get the texture holding the latest state of the automaton.
+        '''
+        return self.textures[self.current]
         
-        V = (G)/64.
-        V[negatives] = -V[negatives]
+    def heightAt(self, x, y):
+        '''
+        Read back the height of texel (x, y) of the latest state, in the same
+        units as the vertex heights. This waits for the GPU to finish the
+        latest step so it should only be used for occasional queries.
+        '''
+        if self.floatHeights:
+            texel = (GLfloat * 1)()
+        else:
+            texel = (GLubyte * 4)()
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.frameBuffers[self.current])
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(int(x), int(y), 1, 1, self.readFormat[0],
+                     self.readFormat[1], texel)
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        if self.floatHeights:
+            return texel[0] / 64.
+        height = texel[1] / 64.
+        return -height if texel[2] else height
+        
+    def createTexture(self):
+        '''
+        Create an NxN texture for storing the state of the ripple automaton.
+        '''
+        texture = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
+                                                     self.N, 
+                                                     self.N,
+                                                     self.heightFormat)
+        # The automaton samples texel centres, filtering is not required.
+        glBindTexture(GL_TEXTURE_2D, texture.id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        return texture
+        
+    def readback(self, rects, destination):
+        '''
+        Read the given rectangles of the latest state into their places in an
+        NxN image at destination. If a pixel pack buffer is bound destination
+        is an offset into it, otherwise it is a ctypes array.
+        '''
+        bytesPerTexel = sizeof(self.buffer) // (self.N * self.N)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.frameBuffers[self.current])
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glPixelStorei(GL_PACK_ROW_LENGTH, self.N)
+        for x, y, w, h in rects:
+            offset = (y * self.N + x) * bytesPerTexel
+            if isinstance(destination, (int, long)):
+                pixels = destination + offset
+            else:
+                pixels = ctypes.byref(destination, offset)
+            glReadPixels(x, y, w, h, self.readFormat[0], self.readFormat[1],
+                         pixels)
+        glPixelStorei(GL_PACK_ROW_LENGTH, 0)
+        glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        
+    def readbackAsync(self, rects):
+        '''
+        Start an asynchronous read of the latest state into the next pixel
+        buffer of the ring and copy the oldest pending read into self.buffer if
+        the GPU has finished writing it. Returns the rectangles of self.buffer
+        that were updated.
+        '''
+        ring = len(self.pixelBuffers)
+        write = self.readbackFrame % ring
+        read = (self.readbackFrame + 1) % ring
+        self.readbackFrame += 1
+        
+        # A read that was never collected is dropped when its slot is reused
+        if self.fences[write]:
+            glDeleteSync(self.fences[write])
+            self.fences[write] = None
+            
+        # Queue the read of this frame's heightfield, glReadPixels returns
+        # immediately as the destination is a buffer object.
+        if rects:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixelBuffers[write])
+            self.readback(rects, 0)
+            self.fences[write] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            self.pendingRects[write] = rects
+        
+        # Collect the read queued readbackLatency frames ago without waiting,
+        # if it is not ready yet the vertices keep their previous heights.
+        updated = []
+        fence = self.fences[read]
+        if fence:
+            status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+            if status in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                glDeleteSync(fence)
+                self.fences[read] = None
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixelBuffers[read])
+                data = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+                if data:
+                    memmove(self.buffer, data, sizeof(self.buffer))
+                    updated = self.pendingRects[read]
+                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+                
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        return updated
         
-        verts[:self.N:,:self.N:,1] = V
+    def decode(self, verts, rects):
+        '''
+        Decode the heights held in the given rectangles of self.buffer into the
+        vertex array.
+        '''
+        if self.floatHeights:
+            V = np.frombuffer(self.buffer, np.float32).reshape(self.N,self.N)
+            nonzero = V != 0.0
+            V = V / 64.
+        else:
+            # Channel R maps to the values 0 - 1 in steps of 2**-8
+            # Channel G maps to the values 1 - 256 in steps of 1
+            # Channel B denotes the sign of the pixel, where 0.0 is positive and 1.0 is negative.
+            texels = np.frombuffer(self.buffer, np.uint8).reshape(self.N,self.N,4)
+            R = texels[:,:,0]
+            G = texels[:,:,1]
+            B = texels[:,:,2]
+            
+            nonzero = (R > 0) | (G > 0)
+            negatives = B >= 1.0
+            
+            V = (G)/64.
+            V[negatives] = -V[negatives]
         
-        # Restore viewport
-        glViewport(0, 0, self.camera.width, self.camera.height)
+        for x, y, w, h in rects:
+            verts[y:y + h, x:x + w, 1] = V[y:y + h, x:x + w]
+        if self.blocks:
+            self.blocks.measure(nonzero, rects)
         
     def tap(self, tapPosition):
-        self.tapped = True
-        self.tapPosition = tapPosition/self.N
-        
-    def renderToFBO(self,frameBufferHandle, textureHandleA, textureHandleB):
-        # Use the ping-pong FBO technique.
-        # Terminology:
-        # frameBufferHandle is the FBO of the current output texture.
-        # textureHandleA is the handle of the texture currently set as output.
-        # textureHandleB is the handle of the texture currently set as input.
-        # textureCHandle is a handle to a texture that is a copy of A, which will
-        # allow us to access A's while it is bound as an output.
-        
-        # First copy the timestep-2 (current buffer) texture to buffer C so that
-        # it may be read by the shader as it writes to the current buffer.
-        self.renderToCopy(textureHandleA)
-        
-        # Bind FBO A/B to set Texture A/B as the output texture
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, frameBufferHandle)
-            
+        x = tapPosition.x / float(self.N)
+        y = tapPosition.y / float(self.N)
+        self.taps.extend([x, y])
+        if self.blocks:
+            self.blocks.mark(x, y, kTapRadius)
+        
+    def simulate(self, steps, rects):
+        '''
+        Advance the automaton by the given number of steps. Each step renders
+        the new state into the texture holding the oldest state, reading the
+        previous state for the neighbour average and the state before that as
+        the current value. The shader, quad and viewport are set up once and
+        the steps are issued back-to-back.
+        
+        Only the texels inside rects (x, y, width, height) are rendered, the
+        rest of each texture is left untouched.
+        '''
+        if not rects:
+            return
+        sparse = rects != self.fullRect
+        if sparse:
+            glEnable(GL_SCISSOR_TEST)
+        
         # Set the viewport to the size of the texture 
         # (we are going to render to texture)
         glViewport(0,0, self.N, self.N)
-            
-        # Clear the output texture
-        glClear (GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
              
         # Bind the automata shader
         glUseProgram(self.rippleShader.id)
-            
-        # Make texture register 0 active and bind texture B/A as the input
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, textureHandleB.id)     
-        # Tell the texture uniform sampler to use this texture in the shader by
-        #binding to texture unit 0.
+        # Texture unit 0 holds the previous state, unit 2 the current state
         glUniform1i(self.rippleTextureHandle, 0)
-        
-        glActiveTexture(GL_TEXTURE2)
-        glBindTexture(GL_TEXTURE_2D, self.textureC.id)
         glUniform1i(self.rippleCopyTextureHandle, 2)
-             
-        # Update the 'tapped' uniform for user interaction
-        if self.tapped:
-            self.tapped = False
-            glUniform1i(self.rippleTapHandle, 1)
-            glUniform2fv(   self.rippleTapPosHandle,
-                            1,
-                            self.tapPosition.elements())
-        else:
-            glUniform1i(self.rippleTapHandle, 0)
-            glUniform2fv(   self.rippleTapPosHandle,
-                            1,
-                            self.tapPosition.elements())
-
-        # Set up vertices VBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)  
+        glUniform1f(self.ripplePixelSizeHandle, 1.0 / self.N)
         
-        glBufferData(   GL_ARRAY_BUFFER,
-                        sizeof(self.vertices),
-                        self.vertices,
-                        GL_STATIC_DRAW)
-    
-        # Set up vertex attributes
-        glEnableVertexAttribArray(self.ripplePositionHandle)
-        glVertexAttribPointer(  self.ripplePositionHandle,
-                                3,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                self.vertexSize,
-                                0)
-                                
-        glEnableVertexAttribArray(self.rippleTexcoordHandle)          
-        glVertexAttribPointer(  self.rippleTexcoordHandle,
-                                2,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                self.vertexSize,
-                                self.offsetTexcoords)
-
-        # Draw fullscreen quad
-        glDrawElements(GL_TRIANGLES,
-                       len(self.indices), 
-                       GL_UNSIGNED_SHORT,
-                       self.indices)
-                                                            
-        # Disable arrays
-        glDisableVertexAttribArray(self.ripplePositionHandle)
-        glDisableVertexAttribArray(self.rippleTexcoordHandle)
-        # Unbind shader and FBO
-        glUseProgram(0)   
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)                          
-    def renderToCopy(self, textureToCopy):
-        # Bind FBO C to set Texture C as the output texture
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.frameBufferC)
-
-        # Set the viewport to the size of the texture 
-        # (we are going to render to texture)
-        glViewport(0,0, self.N, self.N)
+        glBindVertexArray(self.VAO)
+        
+        for i in range(steps):
+            previous = self.current
+            current = (self.current + 2) % 3
+            output = (self.current + 1) % 3
             
-        # Clear the output texture
-        glClear (GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-             
-        # Bind the passthru shader
-        glUseProgram(self.copyShader.id)
+            # Bind the FBO of the output texture
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.frameBuffers[output])
             
-        # Make texture register 0 active and bind texture B/A as the input
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, textureToCopy.id)     
-        # Tell the texture uniform sampler to use this texture in the shader by
-        #binding to texture unit 0.
-        glUniform1i(self.copyTextureHandle, 0)
-        
-        
-        # Set up vertices VBO
-        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)  
-        
-        glBufferData(   GL_ARRAY_BUFFER,
-                        sizeof(self.vertices),
-                        self.vertices,
-                        GL_STATIC_DRAW)
-    
-        # Set up vertex attributes
-        glEnableVertexAttribArray(self.copyPositionHandle)
-        glVertexAttribPointer(  self.copyPositionHandle,
-                                3,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                self.vertexSize,
-                                0)
-                                
-        glEnableVertexAttribArray(self.copyTexcoordHandle)          
-        glVertexAttribPointer(  self.copyTexcoordHandle,
-                                2,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                self.vertexSize,
-                                self.offsetTexcoords)
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_2D, self.textures[previous].id)     
+            glActiveTexture(GL_TEXTURE2)
+            glBindTexture(GL_TEXTURE_2D, self.textures[current].id)
+            
+            # Upload the next batch of queued taps
+            count = min(len(self.taps) // 2, kMaxTaps)
+            if count:
+                glUniform2fv(   self.rippleTapsHandle,
+                                count,
+                                (GLfloat * (count * 2))(*self.taps[:count * 2]))
+                del self.taps[:count * 2]
+            if i == 0 or count != tapCount:
+                glUniform1i(self.rippleTapCountHandle, count)
+                tapCount = count
 
-        # Draw fullscreen quad
-        glDrawElements(GL_TRIANGLES,
-                       len(self.indices), 
-                       GL_UNSIGNED_SHORT,
-                       self.indices)
-                       
-        # Disable arrays
-        glDisableVertexAttribArray(self.copyPositionHandle)
-        glDisableVertexAttribArray(self.copyTexcoordHandle)
-        # Unbind shader and FBO
-        glUseProgram(0)                
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)  
- 
-    
\ No newline at end of file
+            # Draw fullscreen quad, every texel (of each rect) is written so no
+            # clear is needed
+            if sparse:
+                for x, y, w, h in rects:
+                    glScissor(x, y, w, h)
+                    glDrawElements( GL_TRIANGLES,
+                                    self.indexCount,
+                                    GL_UNSIGNED_SHORT,
+                                    0)
+            else:
+                glDrawElements(GL_TRIANGLES, self.indexCount, GL_UNSIGNED_SHORT, 0)
+            
+            self.current = output
+        
+        # Unbind textures, quad, shader and FBO
+        if sparse:
+            glDisable(GL_SCISSOR_TEST)
+        glBindVertexArray(0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glUseProgram(0)   
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
@@ -104,3 +104,18 @@ class Matrix16():
                          0.0, 0.0, b,    0.0)        
                          
                          
+                         
+    @classmethod
+    def inverse_perspective(self, width, height, vFOV, fzNear, fzFar):
+        """
+        The inverse of the perspective projection for the given viewport,
+        transforms from clip space back to camera space.
+        """
+        f = 1/tan(vFOV*pi/360.)
+        p = width / float(height)
+        a = (fzFar+fzNear)/(fzNear-fzFar)
+        b = (2*fzFar*fzNear)/(fzNear-fzFar)
+        return Matrix16( p/f, 0.0, 0.0,  0.0, \
+                         0.0, 1/f, 0.0,  0.0, \
+                         0.0, 0.0, 0.0,  1/b, \
+                         0.0, 0.0, -1.0, a/b)
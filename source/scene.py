@@ -49,6 +49,8 @@ class Scene():
         self.status.addParameter('Time')
         self.status.addParameter('Caustics intensity')
         self.status.addParameter('Caustics scale')
+        self.status.addParameter('Caustics resolution')
+        self.status.addParameter('Visible tiles')
         
         self.time = 0.0
         
@@ -64,11 +66,27 @@ class Scene():
         self.oceanTiles = Vector2(
                             self.options.getint('Scene', 'oceantilesx'),
                             self.options.getint('Scene', 'oceantilesy'))
+        self.instancedTiles = self.options.getboolean('Scene', 'instancedtiles')
+        self.cullTiles = self.options.getboolean('Scene', 'culltiles')
+        self.followCamera = self.options.getboolean('Scene', 'followcamera')
+        self.lodLevels = self.options.getint('Scene', 'lodlevels')
+        self.projectedGrid = self.options.getboolean('Scene', 'projectedgrid')
+        self.compactVertices = self.options.getboolean('Scene', 'compactvertices')
+        self.gpuDisplacement = self.options.getboolean('Scene', 'gpudisplacement')
         self.drawSurface = True
         self.drawFloor = True
         self.enableCaustics = True
         self.causticIntensity= self.options.getfloat('Scene','causticintensity')
         self.causticPhotonScale = self.options.getfloat('Scene', 'causticscale')
+        self.causticResolution = 1
+        self.causticCacheSize = self.options.getint('Scene', 'causticcachesize')
+        self.causticLayers = self.options.getint('Scene', 'causticlayers')
+        # A directory of frames saved with main.py --grab, empty for none
+        self.causticFrames = self.options.get('Scene', 'causticframes') or None
+        self.photonGrid = self.options.getint('Scene', 'photongrid')
+        self.causticTriangles = self.options.getboolean('Scene', 'caustictriangles')
+        self.causticLaplacian = self.options.getboolean('Scene', 'causticlaplacian')
+        self.causticSpectral = self.options.getboolean('Scene', 'causticspectral')
         self.period = self.options.getfloat('Scene', 'period')
         self.env_path = self.options.get('Scene', 'env_path')
         self.frame = 0
@@ -107,7 +125,21 @@ class Scene():
                             tilesZ=self.oceanTiles.y,
                             photonScale=self.causticPhotonScale,
                             photonIntensity=self.causticIntensity,
-                            period=self.period)
+                            period=self.period,
+                            causticCacheSize=self.causticCacheSize,
+                            causticLayers=self.causticLayers,
+                            causticFrames=self.causticFrames,
+                            photonGrid=self.photonGrid,
+                            causticTriangles=self.causticTriangles,
+                            causticLaplacian=self.causticLaplacian,
+                            causticSpectral=self.causticSpectral,
+                            instancedTiles=self.instancedTiles,
+                            cullTiles=self.cullTiles,
+                            followCamera=self.followCamera,
+                            lodLevels=self.lodLevels,
+                            projectedGrid=self.projectedGrid,
+                            compactVertices=self.compactVertices,
+                            gpuDisplacement=self.gpuDisplacement)
                                      
         self.scene.append(self.ocean)        
 
@@ -122,6 +154,11 @@ class Scene():
         self.status.setParameter('Time', self.time)
         self.status.setParameter('Caustics intensity', self.causticIntensity)
         self.status.setParameter('Caustics scale', self.causticPhotonScale) 
+        self.status.setParameter('Caustics resolution',
+                                 '1/' + str(self.causticResolution))
+        self.status.setParameter('Visible tiles',
+                                 str(self.ocean.surface.visibleTiles) + '/' +
+                                 str(len(self.ocean.surface.tiles)))
 
     def draw(self, dt):
     
@@ -170,25 +207,28 @@ class Scene():
     def frameGrab(self, dt, directory=""):
         '''
         Save successive caustic frames to an image sequence so that it may be
-        used as an animated texture or video in another program
+        used as an animated texture or video in another program. Frame k
+        shows the surface at time k * dt, matching the layers of a
+        CausticArray (see CausticArray.setTime).
         '''
-        self.time += dt
-        # Update the ocean surface so caustics can be generated
-        self.ocean.surface.update(dt)
-        # Update caustics
-        self.ocean.caustics.update(dt)
         # Save the caustic texture to output image until a full period of the
         # ocean surface has been processed
-        if self.time < self.period:
-            self.ocean.causticTexture.save(directory + '/frame_' + 
-                ('%03d' % self.frame) + '.png')
-            print("Saved " + directory + '/frame_' + 
-                ('%03d' % self.frame) + '.png')
-            self.frame += 1
-        else:
+        if self.time >= self.period:
             print("Frame grabbing is complete, " + str(self.frame)
                   + " frames were generated in " + directory)
             return True
+        # Update the ocean surface to the frame's time so caustics can be
+        # generated
+        self.ocean.surface.update(self.time - self.ocean.surface.time,
+                                  force=True)
+        # Update caustics
+        self.ocean.caustics.update(dt)
+        self.ocean.causticTexture.save(directory + '/frame_' + 
+            ('%03d' % self.frame) + '.png')
+        print("Saved " + directory + '/frame_' + 
+            ('%03d' % self.frame) + '.png')
+        self.frame += 1
+        self.time += dt
         return False
     
     def cameraUpdate(self, dt):
@@ -247,6 +287,10 @@ class Scene():
             self.ocean.enableCaustics = self.enableCaustics
         if symbol == key.P:
             self.ocean.reloadShaders()
+        if symbol == key.B:
+            # Cycle the photon map through full, half and quarter resolution
+            self.causticResolution = {1: 2, 2: 4, 4: 1}[self.causticResolution]
+            self.ocean.setCausticResolution(self.causticResolution)
             
     def isKeyPressed(self, symbol):
         if symbol in self.pressedKeys:
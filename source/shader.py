@@ -29,13 +29,31 @@ def read_source(fname):
     return src
   
 
-def openfiles(vertex, fragment):  
-    fsrc = read_source(fragment)
+def preprocess(src, defines=None):
+    '''
+    Insert a #define for each name in defines at the top of the source, after
+    the #version directive if there is one.
+    '''
+    if not defines:
+        return src
+    header = ''.join(['#define %s\n' % define for define in defines])
+    if src.lstrip().startswith('#version'):
+        version, _, body = src.lstrip().partition('\n')
+        return version + '\n' + header + body
+    return header + src
+
+
+def openfiles(vertex, fragment, defines=None, geometry=None):  
+    fsrc = preprocess(read_source(fragment), defines)
     fshader = FragmentShader([fsrc])
-    vsrc = read_source(vertex)
+    vsrc = preprocess(read_source(vertex), defines)
     vshader = VertexShader([vsrc])
+    shaders = [fshader, vshader]
+    if geometry:
+        gsrc = preprocess(read_source(geometry), defines)
+        shaders.append(GeometryShader([gsrc]))
 
-    program = ShaderProgram(fshader, vshader)
+    program = ShaderProgram(*shaders)
     program.use()
     return program
 
@@ -106,6 +124,10 @@ class FragmentShader(_Shader):
     type = gl.GL_FRAGMENT_SHADER
 
 
+class GeometryShader(_Shader):
+    type = gl.GL_GEOMETRY_SHADER
+
+
 
 class ShaderProgram(object):
 
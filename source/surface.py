@@ -4,12 +4,54 @@ from vector import Vector2, Vector3
 from matrix16 import Matrix16
 from utilities import *
 from ctypes import pointer, sizeof, c_float
+from math import floor
+
+# Compact vertex format: displacement (x, y, z, unused) and the X and Z of the
+# unit normal as normalised shorts, 12 bytes per vertex
+kCompactVertex = np.dtype([('displacement', np.float16, 4),
+                           ('normal', np.int16, 2)])
 
 class Surface():
     '''
     The ocean surface is formed from a 2D tiled mesh where the vertices are 
     displaced according to a heightfield generated from a surface generator
     object.
+    
+    If displacement is True the mesh is never re-uploaded. The vertex shader
+    (compiled with RIPPLE_DISPLACEMENT or TESSENDORF_DISPLACEMENT defined)
+    samples the heightfield's texture, see Ripples.getTexture and
+    Tessendorf.getTexture, to displace the static grid and derives the
+    normals from the neighbouring texels.
+    
+    If instanced is True all tiles are drawn with a single instanced draw
+    call. The shader (compiled with INSTANCED_TILES defined) translates each
+    instance by its vTileOffset attribute, see uploadTileOffsets.
+    
+    If cull is True only the tiles whose bounding box intersects the camera
+    frustum are drawn, see cullTiles. The number of tiles drawn by the last
+    draw call is kept in visibleTiles.
+    
+    If follow is True the grid of tiles is centred on the camera and scrolls
+    with it a whole tile at a time, see updateOrigin. As the heightfield is
+    periodic the scrolling is seamless, giving an unbounded ocean for the
+    cost of a fixed number of tiles.
+    
+    If lodLevels is greater than one, tiles further than lodDistance tiles
+    from the camera are drawn with every 2nd, 4th... vertex of the same
+    vertex buffer, see selectLevels. The reduced index ranges are stored
+    after the full detail indices, with stitched borders for each
+    combination of coarser neighbours (see Mesh2DSurfaceLOD).
+    
+    If projected is True the surface is drawn as a single gridSize x gridSize
+    grid in screen space instead of tiles. The shader (compiled with
+    PROJECTED_GRID defined) projects each grid point onto the water plane and
+    displaces it by sampling the heightfield, which is uploaded into textures
+    after every update. The tile vertex buffer is still kept up to date for
+    the caustics.
+    
+    If compact is True the vertex buffer holds kCompactVertex vertices, see
+    packVertices. The shaders (compiled with COMPACT_VERTICES defined) find
+    the grid point of each vertex from gl_VertexID.
     '''
     def __init__(self,
                  shaderProgram,
@@ -22,7 +64,16 @@ class Surface():
                  tilesX=1,
                  tilesZ=1,
                  scale=1.0, 
-                 offset=Vector3(0.0,0.0,0.0)):
+                 offset=Vector3(0.0,0.0,0.0),
+                 displacement=False,
+                 instanced=False,
+                 cull=False,
+                 follow=False,
+                 lodLevels=1,
+                 lodDistance=1.5,
+                 projected=False,
+                 gridSize=128,
+                 compact=False):
         
         '''
         Initial setup of constants and openGL attribute and uniform handles
@@ -31,19 +82,42 @@ class Surface():
         self.offset = offset            # World space offset
         self.scale = scale              # Size of each quad in world space
         self.camera = camera            # A camera object (provides MVP)
-        self.tileCount = Vector2(tilesX,tilesZ)
         self.texture = texture
         self.causticTexture = causticTexture
         self.cubemapTexture = cubemapTexture
+        self.displacement = displacement
+        self.instanced = instanced
+        self.cull = cull
+        self.follow = follow
+        self.lodLevels = lodLevels
+        self.lodDistance = lodDistance
+        # The coarsest level still needs an inner grid
+        while self.lodLevels > 1 and 2**self.lodLevels > self.tileSize:
+            self.lodLevels -= 1
+        self.tileOrigin = Vector2(0, 0) # Index of the first tile
+        self.projected = projected
+        self.compact = compact
+        # The projected grid has its own vertices, displaced vertices are
+        # never uploaded
+        assert [self.projected, self.compact, self.displacement].count(True) <= 1
         # Set the shader and obtain references to shader uniforms/attributes
         self.setShader(shaderProgram)
         # Generate a 2D plane composed of tiled Quads
         # Directly access the positions, normals and indices of the mesh
-        self.verts, self.indices = Mesh2DSurface(self.tileSize, self.scale)
+        verts, self.indices = Mesh2DSurface(self.tileSize, self.scale)
+        # Positions and normals change with the heightfield, the texture
+        # coordinates never change and are kept in their own buffer
+        self.verts = np.ascontiguousarray(verts[...,:6])
+        self.texCoords = np.ascontiguousarray(verts[...,6:])
+        if self.compact:
+            self.packed = np.zeros(self.verts.shape[0] * self.verts.shape[1],
+                                   dtype=kCompactVertex)
         # Keep a copy of the original vertex positions and apply displacements
         # from the heightfield to them to produce new vertex positions
         self.v0 = self.verts.copy()
         self.vertexCount = self.indices.size
+        self.updateBounds()
+        self.size(tilesX, tilesZ)
         
         self.modelMatrix = Matrix16()
         self.modelMatrix[12] = self.offset.x
@@ -59,58 +133,74 @@ class Surface():
         glGenVertexArrays(1,pointer(self.VAO))
         glBindVertexArray(self.VAO)
         
-        # Vertex Buffer Objects (Positions Normals and Indices)
+        # Vertex Buffer Objects (Positions Normals, TexCoords and Indices)
         self.vertVBO = GLuint()
+        self.texCoordVBO = GLuint()
         self.indexVBO = GLuint()
         glGenBuffers(1, pointer(self.vertVBO))
+        glGenBuffers(1, pointer(self.texCoordVBO))
         glGenBuffers(1, pointer(self.indexVBO))
                 
-        indicesGL = np.ctypeslib.as_ctypes(self.indices)
-        vertsGL = np.ctypeslib.as_ctypes(self.verts)
-        vertexSize = sizeof(GLfloat) * 8
-        offsetNormals = sizeof(GLfloat) * 3
-        offsetTexture = sizeof(GLfloat) * 6
+        # Reduced detail index ranges (byte offset, count) by level and
+        # coarse edge mask, stored after the full detail indices
+        self.lodRanges = {}
+        lodIndices = [self.indices.ravel()]
+        offset = self.indices.size
+        for level in range(self.lodLevels if self.lodLevels > 1 else 0):
+            # The coarsest level has no coarser neighbours
+            masks = 16 if level < self.lodLevels - 1 else 1
+            for mask in range(masks):
+                coarse = [bool(mask & (1 << edge)) for edge in range(4)]
+                indices = Mesh2DSurfaceLOD(self.tileSize, 2**level, coarse)
+                self.lodRanges[level, mask] = (offset * 4, indices.size)
+                lodIndices.append(indices)
+                offset += indices.size
+            
+        indicesGL = np.ctypeslib.as_ctypes(np.concatenate(lodIndices))
+        vertsGL = np.ctypeslib.as_ctypes(self.vertexData())
+        texCoordsGL = np.ctypeslib.as_ctypes(self.texCoords)
 
-        # Set up vertices VBO (associated with VAO)
+        # Upload the vertices and indices
         glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)      
-        glBufferData(GL_ARRAY_BUFFER, sizeof(vertsGL), vertsGL, GL_STATIC_DRAW)
-        # Positions
-        glEnableVertexAttribArray(self.positionHandle) 
-        glVertexAttribPointer(  self.positionHandle,
-                                3,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                vertexSize,
-                                0)
-        # Normals
-        glEnableVertexAttribArray(self.normalHandle) 
-        glVertexAttribPointer(  self.normalHandle,
-                                3,
-                                GL_FLOAT,
-                                GL_FALSE,
-                                vertexSize,
-                                offsetNormals)
-        
-        if self.texture:
-            # TexCoords
-            glEnableVertexAttribArray(self.texCoordHandle) 
-            glVertexAttribPointer(  self.texCoordHandle,
-                                    2,
-                                    GL_FLOAT,
-                                    GL_FALSE,
-                                    vertexSize,
-                                    offsetTexture)
-            
-        # Set up indices VBO (associated with VAO)
-        # Indices
+        glBufferData(GL_ARRAY_BUFFER, sizeof(vertsGL), vertsGL, GL_STREAM_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, self.texCoordVBO)      
+        glBufferData(   GL_ARRAY_BUFFER,
+                        sizeof(texCoordsGL),
+                        texCoordsGL,
+                        GL_STATIC_DRAW)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexVBO)      
         glBufferData(   GL_ELEMENT_ARRAY_BUFFER,
                         sizeof(indicesGL),
                         indicesGL,
                         GL_STATIC_DRAW)
+        
+        # Associate the VBOs with the VAO
+        if self.texture or self.displacement:
+            self.bindVertexAttributes(  self.positionHandle,
+                                        self.normalHandle,
+                                        self.texCoordHandle)
+        else:
+            self.bindVertexAttributes(self.positionHandle, self.normalHandle)
+            
+        # Per-instance tile offsets
+        if self.instanced:
+            self.tileVBO = GLuint()
+            glGenBuffers(1, pointer(self.tileVBO))
+            self.uploadTileOffsets(self.tiles)
+            glEnableVertexAttribArray(self.tileOffsetAttribHandle)
+            glVertexAttribPointer(  self.tileOffsetAttribHandle,
+                                    2,
+                                    GL_FLOAT,
+                                    GL_FALSE,
+                                    0,
+                                    0)
+            glVertexAttribDivisor(self.tileOffsetAttribHandle, 1)
 
         glBindVertexArray(0)
         
+        if self.projected:
+            self.setupProjectedGrid(gridSize)
+        
         '''
         Set up the surface generator. The surface generator creates a
         heightfield representing the surface of an ocean using the FFT synthesis
@@ -118,12 +208,19 @@ class Surface():
         '''
         # Ocean Heightfield Generator
         self.time = 0.0
-        self.heightfield = heightfield
+        self.setHeightfield(heightfield)
     def setShader(self, shader):
         self.shader = shader     # The GLSL shader program handle
+        # Uniforms are uploaded on the next draw
+        self.cameraVersion = None
+        self.uniformsDirty = True
         # Set up GLSL uniform and attribute handles
-        self.positionHandle = glGetAttribLocation(self.shader.id, "vPosition")
-        self.normalHandle = glGetAttribLocation(self.shader.id, "vNormal")
+        if self.compact:
+            self.positionHandle = glGetAttribLocation(self.shader.id, "vDisplacement")
+            self.normalHandle = glGetAttribLocation(self.shader.id, "vNormalXZ")
+        else:
+            self.positionHandle = glGetAttribLocation(self.shader.id, "vPosition")
+            self.normalHandle = glGetAttribLocation(self.shader.id, "vNormal")
         self.texCoordHandle = glGetAttribLocation(self.shader.id, "vTexCoord")
         self.modelMatrixHandle = glGetUniformLocation(self.shader.id, "model")
         self.viewMatrixHandle = glGetUniformLocation(self.shader.id, "view")
@@ -137,7 +234,155 @@ class Surface():
         self.tileSizeHandle = glGetUniformLocation(self.shader.id, "tileSize") 
         self.tileCountHandle = glGetUniformLocation(self.shader.id, "tileCount")
         self.tileOffsetHandle = glGetUniformLocation(self.shader.id, "tileOffset")
+        self.tileOffsetAttribHandle = glGetAttribLocation(self.shader.id, "vTileOffset")
+        self.tileOriginHandle = glGetUniformLocation(self.shader.id, "tileOrigin")
+        
+        self.heightsHandle = glGetUniformLocation(self.shader.id, "heights")
+        self.gridScaleHandle = glGetUniformLocation(self.shader.id, "gridScale")
+        self.causticLayerHandle = glGetUniformLocation(self.shader.id, "causticLayer")
+        self.causticLayersHandle = glGetUniformLocation(self.shader.id, "causticLayers")
+        self.inverseProjectionHandle = glGetUniformLocation(self.shader.id, "inverseProjection")
+        self.inverseViewHandle = glGetUniformLocation(self.shader.id, "inverseView")
+        self.displacementsHandle = glGetUniformLocation(self.shader.id, "displacements")
+        self.normalsHandle = glGetUniformLocation(self.shader.id, "normals")
+    def setupProjectedGrid(self, gridSize):
+        '''
+        Create the screen space grid and the heightfield textures sampled by
+        the projected grid. The grid reaches a little past the edges of the
+        screen so the displaced edges stay out of view.
+        '''
+        margin = 1.1
+        gridVerts, gridIndices = Mesh2DSurface(gridSize, 2.0 * margin / gridSize)
+        gridVerts[...,0] -= margin
+        gridVerts[...,2] -= margin
+        self.gridCount = gridIndices.size
+        
+        self.gridVAO = GLuint()
+        glGenVertexArrays(1, pointer(self.gridVAO))
+        glBindVertexArray(self.gridVAO)
+        
+        self.gridVBO = GLuint()
+        self.gridIndexVBO = GLuint()
+        glGenBuffers(1, pointer(self.gridVBO))
+        glGenBuffers(1, pointer(self.gridIndexVBO))
+        
+        vertsGL = np.ctypeslib.as_ctypes(gridVerts)
+        indicesGL = np.ctypeslib.as_ctypes(gridIndices)
+        glBindBuffer(GL_ARRAY_BUFFER, self.gridVBO)
+        glBufferData(GL_ARRAY_BUFFER, sizeof(vertsGL), vertsGL, GL_STATIC_DRAW)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.gridIndexVBO)
+        glBufferData(   GL_ELEMENT_ARRAY_BUFFER,
+                        sizeof(indicesGL),
+                        indicesGL,
+                        GL_STATIC_DRAW)
+                        
+        # Only the grid positions are used
+        glEnableVertexAttribArray(self.positionHandle) 
+        glVertexAttribPointer(  self.positionHandle,
+                                3,
+                                GL_FLOAT,
+                                GL_FALSE,
+                                sizeof(GLfloat) * 8,
+                                0)
+        glBindVertexArray(0)
+        
+        def createTexture():
+            texture = image.DepthTexture.create_for_size(GL_TEXTURE_2D, 
+                                                         self.tileSize, 
+                                                         self.tileSize,
+                                                         GL_RGB32F)
+            glBindTexture(GL_TEXTURE_2D, texture.id)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+            glBindTexture(GL_TEXTURE_2D, 0)
+            return texture
+        self.displacementTexture = createTexture()
+        self.normalTexture = createTexture()
+        self.uploadHeightfieldTextures()
+        
+    def uploadHeightfieldTextures(self):
+        '''
+        Copy the heightfield displacements and normals from the vertex array
+        into the textures sampled by the projected grid. The last row and
+        column duplicate the first and are left to the texture wrapping.
+        '''
+        N = self.tileSize
+        displacements = self.verts[:N,:N,:3] - self.v0[:N,:N,:3]
+        normals = self.verts[:N,:N,3:6]
+        for texture, texels in [(self.displacementTexture, displacements),
+                                (self.normalTexture, normals)]:
+            texels = np.ascontiguousarray(texels, dtype=np.float32)
+            glBindTexture(GL_TEXTURE_2D, texture.id)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, N, N,
+                            GL_RGB, GL_FLOAT,
+                            np.ctypeslib.as_ctypes(texels))
+        glBindTexture(GL_TEXTURE_2D, 0)
+        
+    def bindVertexAttributes(self,
+                             positionHandle,
+                             normalHandle,
+                             texCoordHandle=-1):
+        '''
+        Point the given attributes at this surface's vertex and index buffers
+        in the currently bound vertex array object. Other renderers of the
+        surface (e.g. Caustics) use this to share the buffers, so the vertices
+        are only uploaded once per update.
+        
+        For compact vertices the position and normal attributes receive the
+        displacement and the normal X and Z (see packVertices).
+        '''
+        if self.compact:
+            vertexSize = kCompactVertex.itemsize
+            offsetNormals = kCompactVertex.fields['normal'][1]
+            positionFormat = (3, GL_HALF_FLOAT, GL_FALSE)
+            normalFormat = (2, GL_SHORT, GL_TRUE)
+        else:
+            vertexSize = sizeof(GLfloat) * 6
+            offsetNormals = sizeof(GLfloat) * 3
+            positionFormat = (3, GL_FLOAT, GL_FALSE)
+            normalFormat = (3, GL_FLOAT, GL_FALSE)
+        
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)
+        # Positions
+        glEnableVertexAttribArray(positionHandle) 
+        glVertexAttribPointer(  positionHandle,
+                                positionFormat[0],
+                                positionFormat[1],
+                                positionFormat[2],
+                                vertexSize,
+                                0)
+        # Normals
+        if normalHandle >= 0:
+            glEnableVertexAttribArray(normalHandle) 
+            glVertexAttribPointer(  normalHandle,
+                                    normalFormat[0],
+                                    normalFormat[1],
+                                    normalFormat[2],
+                                    vertexSize,
+                                    offsetNormals)
+        # TexCoords
+        if texCoordHandle >= 0:
+            glBindBuffer(GL_ARRAY_BUFFER, self.texCoordVBO)
+            glEnableVertexAttribArray(texCoordHandle) 
+            glVertexAttribPointer(  texCoordHandle,
+                                    2,
+                                    GL_FLOAT,
+                                    GL_FALSE,
+                                    0,
+                                    0)
+        # Indices
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexVBO)
+        
     def setHeightfield(self, heightfield):
+        # The bounds of tiles displaced on the GPU are padded by the largest
+        # displacement, which not every heightfield can bound
+        assert not (self.cull and self.displacement and heightfield) or \
+               heightfield.maxDisplacement is not None
+        # GPU displacement samples the heightfield's texture
+        assert not (self.displacement and heightfield) or \
+               heightfield.getTexture()
         self.heightfield = heightfield
         
     def setDepth(self, depth):
@@ -147,26 +392,276 @@ class Surface():
         '''
         self.offset.y = depth
 
-    def update(self, dt):
+    def update(self, dt, force=False):
         '''
         If deltaTime is not zero, perform an ocean surface update for time T.
         This update will run heightmap, diplacement and normal generation
         routines and then passes the updated values into the vertex array.
+        If force is set the surface is regenerated even if deltaTime is zero,
+        e.g. after the heightfield has been replaced.
         '''
-        if dt > 0.0 and self.heightfield:
+        if (dt > 0.0 or force) and self.heightfield:
             self.time += dt
             self.heightfield.update(self.time, self.verts, self.v0)
-            # Update the vertex VBO
-            glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)
+            if self.cull:
+                self.updateBounds()
+                if self.displacement:
+                    # The vertices are displaced on the GPU
+                    self.boundsMin = self.boundsMin - self.heightfield.maxDisplacement
+                    self.boundsMax = self.boundsMax + self.heightfield.maxDisplacement
+            if self.projected:
+                self.uploadHeightfieldTextures()
+            if self.displacement:
+                # The vertex shader reads the heights from the GPU directly
+                return
+            self.upload()
             
-            glBufferData(GL_ARRAY_BUFFER, 
-                         self.verts.size*4, 
-                         np.ctypeslib.as_ctypes(self.verts),
-                         GL_STATIC_DRAW)
+    def upload(self):
+        '''
+        Update the vertex VBO from the vertex array. The old store is orphaned
+        first so the driver can hand out a new one rather than wait for draws
+        still reading it.
+        '''
+        data = self.vertexData()
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertVBO)
+        
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 
+                        0,
+                        data.nbytes, 
+                        np.ctypeslib.as_ctypes(data))
+                        
+    def vertexData(self):
+        '''
+        The contents of the vertex VBO, the vertex array or its compact form.
+        '''
+        if not self.compact:
+            return self.verts
+        return self.packVertices().view(np.uint8)
+        
+    def packVertices(self):
+        '''
+        Pack the vertex array into the compact format. The grid points are
+        not stored, only the displacement of each vertex from its grid point
+        as half floats and the X and Z of its unit normal as normalised
+        shorts. The normal Y is always positive so the shaders recover it
+        from the unit length.
+        '''
+        displacement = (self.verts[...,:3] - self.v0[...,:3]).reshape(-1, 3)
+        normals = self.verts[...,3:6].reshape(-1, 3)
+        normals = normals / np.sqrt((normals**2).sum(axis=1))[:,np.newaxis]
+        self.packed['displacement'][:,:3] = displacement
+        self.packed['normal'] = np.round(normals[:,::2] * 32767)
+        return self.packed
                          
+    def updateBounds(self):
+        '''
+        Update the model space bounding box of a tile from the displaced
+        vertex positions, so it includes the largest wave displacement.
+        '''
+        positions = self.verts[...,:3].reshape(-1, 3)
+        self.boundsMin = positions.min(axis=0)
+        self.boundsMax = positions.max(axis=0)
+        
+    def cullTiles(self):
+        '''
+        Test the bounding box of every tile against the camera frustum and
+        return the (i, j) indices of the tiles which are at least partly
+        inside it.
+        '''
+        extent = self.tileSize * self.scale
+        centre = (self.boundsMin + self.boundsMax) * 0.5 + self.offset.values()
+        centre[0] += self.tileOrigin.x * extent
+        centre[2] += self.tileOrigin.y * extent
+        halfSize = (self.boundsMax - self.boundsMin) * 0.5
+        
+        # Box centres of all tiles
+        centres = np.empty((len(self.tiles), 3))
+        centres[:] = centre
+        centres[:,0] += self.tiles[:,0] * extent
+        centres[:,2] += self.tiles[:,1] * extent
+        
+        # A box is outside the frustum if it is behind any of the planes
+        planes = self.camera.getFrustumPlanes()
+        distance = np.dot(centres, planes[:,:3].T) + planes[:,3]
+        radius = np.dot(np.abs(planes[:,:3]), halfSize)
+        visible = (distance + radius >= 0.0).all(axis=1)
+        return self.tiles[visible]
+        
+    def selectLevels(self):
+        '''
+        Choose a level of detail for every tile from the distance between the
+        camera and the tile centre, limited so neighbouring tiles differ by
+        at most one level. Returns the levels and the coarse edge masks
+        (1 = X-, 2 = X+, 4 = Z-, 8 = Z+) as tilesX x tilesZ arrays.
+        '''
+        extent = self.tileSize * self.scale
+        position = self.camera.position
+        dx = self.offset.x + (self.tileOrigin.x + self.tiles[:,0] + 0.5) * extent
+        dz = self.offset.z + (self.tileOrigin.y + self.tiles[:,1] + 0.5) * extent
+        distance = np.sqrt((dx - position.x)**2 + 
+                           (dz - position.z)**2 + 
+                           (self.offset.y - position.y)**2)
+        levels = (distance / (extent * self.lodDistance)).astype(int)
+        levels = np.clip(levels, 0, self.lodLevels - 1)
+        levels = levels.reshape(self.tileCount.x, self.tileCount.y)
+        
+        def neighbours(levels):
+            padded = np.pad(levels, 1, mode='edge')
+            return (padded[:-2,1:-1], padded[2:,1:-1],
+                    padded[1:-1,:-2], padded[1:-1,2:])
+                    
+        # Refine tiles that are more than one level coarser than a neighbour
+        while True:
+            limit = np.minimum.reduce(neighbours(levels)) + 1
+            if (levels <= limit).all():
+                break
+            levels = np.minimum(levels, limit)
+            
+        masks = np.zeros(levels.shape, dtype=int)
+        for edge, neighbour in enumerate(neighbours(levels)):
+            masks |= (neighbour > levels) << edge
+        return levels, masks
+        
+    def tileGroups(self, tiles):
+        '''
+        Group the given (i, j) tiles by the range of indices they are drawn
+        with. Returns a list of (tiles, byte offset, index count).
+        '''
+        if self.lodLevels <= 1:
+            return [(tiles, 0, self.vertexCount)]
+            
+        levels, masks = self.selectLevels()
+        keys = levels[tiles[:,0], tiles[:,1]] * 16 + masks[tiles[:,0], tiles[:,1]]
+        groups = []
+        for key in np.unique(keys).tolist():
+            offset, count = self.lodRanges[key // 16, key % 16]
+            groups.append((tiles[keys == key], offset, count))
+        return groups
+        
+    def uploadTileOffsets(self, tiles):
+        '''
+        Fill the per-instance buffer with the world space translation of each
+        of the given (i, j) tiles.
+        '''
+        extent = self.tileSize * self.scale
+        offsets = (tiles * extent).astype(np.float32)
+        if not len(tiles):
+            return
+        
+        offsetsGL = np.ctypeslib.as_ctypes(offsets.reshape(-1))
+        glBindBuffer(GL_ARRAY_BUFFER, self.tileVBO)
+        glBufferData(GL_ARRAY_BUFFER, sizeof(offsetsGL), offsetsGL, GL_STREAM_DRAW)
+        
+    def updateOrigin(self):
+        '''
+        Move the grid so the camera is over its centre tile. The grid is
+        snapped to whole tiles so the heightfield lines up across the scroll.
+        '''
+        extent = self.tileSize * self.scale
+        position = self.camera.position
+        origin = Vector2(
+            int(floor((position.x - self.offset.x) / extent)) - self.tileCount.x // 2,
+            int(floor((position.z - self.offset.z) / extent)) - self.tileCount.y // 2)
+        if origin.values() != self.tileOrigin.values():
+            self.tileOrigin = origin
+            self.uniformsDirty = True
+        
     def size(self, tilesX, tilesZ):
         self.tileCount = Vector2(tilesX,tilesZ)
+        self.uniformsDirty = True
+        # Indices (i, j) of all the tiles, tile i * tilesZ + j is (i, j)
+        i, j = np.mgrid[0:tilesX, 0:tilesZ]
+        self.tiles = np.dstack((i, j)).reshape(-1, 2)
+        self.visibleTiles = len(self.tiles)
+        if self.instanced and hasattr(self, 'tileVBO'):
+            self.uploadTileOffsets(self.tiles)
     
+    def drawTiles(self):
+        '''
+        Draw the visible tiles, each translated to its place in the grid.
+        '''
+        # Only submit the tiles in view
+        if self.cull:
+            tiles = self.cullTiles()
+        else:
+            tiles = self.tiles
+        self.visibleTiles = len(tiles)
+        groups = self.tileGroups(tiles)
+        if self.instanced and self.visibleTiles and \
+           (self.cull or self.lodLevels > 1):
+            # Instance offsets in group order
+            self.uploadTileOffsets(np.concatenate([g[0] for g in groups]))
+         
+        glBindVertexArray(self.VAO)
+        
+        # Translate Y 
+        self.modelMatrix[13] = self.offset.y        
+        extent = self.tileSize * self.scale
+        originX = self.offset.x + self.tileOrigin.x * extent
+        originZ = self.offset.z + self.tileOrigin.y * extent
+        
+        if self.instanced:
+            # The tiles are translated by their per-instance offsets
+            self.modelMatrix[12] = originX
+            self.modelMatrix[14] = originZ
+            glUniformMatrix4fv( self.modelMatrixHandle,
+                                1,
+                                False,
+                                self.modelMatrix.elements)
+            first = 0
+            glBindBuffer(GL_ARRAY_BUFFER, self.tileVBO)
+            for group, offset, count in groups:
+                if not len(group):
+                    continue
+                # Start at the group's first instance offset
+                glVertexAttribPointer(  self.tileOffsetAttribHandle,
+                                        2,
+                                        GL_FLOAT,
+                                        GL_FALSE,
+                                        0,
+                                        first * sizeof(GLfloat) * 2)
+                glDrawElementsInstanced(GL_TRIANGLES,
+                                        count,
+                                        GL_UNSIGNED_INT,
+                                        offset,
+                                        len(group))
+                first += len(group)
+        else:
+            for group, offset, count in groups:
+                for i, j in group.tolist():
+                    # Translate X
+                    self.modelMatrix[12] = originX + extent * i
+                    # Translate Z
+                    self.modelMatrix[14] = originZ + extent * j 
+                    glUniform2fv(self.tileOffsetHandle, 1, (c_float*2)(*[i, j]))        
+                    glUniformMatrix4fv( self.modelMatrixHandle,
+                                        1,
+                                        False,
+                                        self.modelMatrix.elements)
+                    glDrawElements(GL_TRIANGLES, count, GL_UNSIGNED_INT, offset)
+        
+    def drawProjectedGrid(self):
+        '''
+        Draw the screen space grid, displaced by the heightfield textures.
+        '''
+        glActiveTexture(GL_TEXTURE3)
+        glBindTexture(GL_TEXTURE_2D, self.displacementTexture.id)
+        glUniform1i(self.displacementsHandle, 3)
+        glActiveTexture(GL_TEXTURE4)
+        glBindTexture(GL_TEXTURE_2D, self.normalTexture.id)
+        glUniform1i(self.normalsHandle, 4)
+        
+        self.modelMatrix[12] = self.offset.x
+        self.modelMatrix[13] = self.offset.y
+        self.modelMatrix[14] = self.offset.z
+        glUniformMatrix4fv( self.modelMatrixHandle,
+                            1,
+                            False,
+                            self.modelMatrix.elements)
+        glBindVertexArray(self.gridVAO)
+        glDrawElements(GL_TRIANGLES, self.gridCount, GL_UNSIGNED_INT, 0)
+        
     def draw(self, dt):
         '''
         Draw this object.
@@ -176,21 +671,42 @@ class Surface():
         # Update the ocean surface heightfield
         self.update(dt)
         
+        if self.follow:
+            self.updateOrigin()
+            
         glUseProgram(self.shader.id)             
-        glUniformMatrix4fv( self.projMatrixHandle,
-                            1,
-                            False,
-                            self.camera.getProjection())
-        glUniformMatrix4fv( self.viewMatrixHandle,
-                            1,
-                            False,
-                            self.camera.getModelView())
-                            
-        glUniform3fv(self.eyeHandle, 3, self.camera.getEye())
-        glUniform3fv(self.eyePositionHandle, 3, self.camera.getPosition())
+        
+        # The program keeps its uniforms, only upload the camera uniforms if
+        # the camera has moved since the last draw
+        if self.cameraVersion != self.camera.version:
+            glUniformMatrix4fv( self.projMatrixHandle,
+                                1,
+                                False,
+                                self.camera.getProjection())
+            glUniformMatrix4fv( self.viewMatrixHandle,
+                                1,
+                                False,
+                                self.camera.getModelView())
+                                
+            glUniform3fv(self.eyeHandle, 1, self.camera.getEye())
+            glUniform3fv(self.eyePositionHandle, 1, self.camera.getPosition())
+            if self.projected:
+                glUniformMatrix4fv( self.inverseProjectionHandle,
+                                    1,
+                                    False,
+                                    self.camera.getInverseProjection())
+                glUniformMatrix4fv( self.inverseViewHandle,
+                                    1,
+                                    False,
+                                    self.camera.getInverseView())
+            self.cameraVersion = self.camera.version
          
-        glUniform1f(self.tileSizeHandle, self.tileSize)
-        glUniform2fv(self.tileCountHandle, 2, self.tileCount.cvalues())
+        if self.uniformsDirty:
+            glUniform1f(self.tileSizeHandle, self.tileSize)
+            glUniform1f(self.gridScaleHandle, self.scale)
+            glUniform2fv(self.tileCountHandle, 1, self.tileCount.cvalues())
+            glUniform2fv(self.tileOriginHandle, 1, self.tileOrigin.cvalues())
+            self.uniformsDirty = False
          
         if self.texture:
             glActiveTexture(GL_TEXTURE0)
@@ -199,33 +715,27 @@ class Surface():
             
         if self.causticTexture:
             glActiveTexture(GL_TEXTURE1)
-            glBindTexture(GL_TEXTURE_2D, self.causticTexture.id)
+            glBindTexture(self.causticTexture.target, self.causticTexture.id)
             glUniform1i(self.causticTextureHandle, 1)
+            if self.causticTexture.target == GL_TEXTURE_2D_ARRAY:
+                # Baked caustics (see CausticArray)
+                glUniform1f(self.causticLayerHandle, self.causticTexture.layer)
+                glUniform1f(self.causticLayersHandle, self.causticTexture.layers)
             
         if self.cubemapTexture:
             glActiveTexture(GL_TEXTURE2)
             glBindTexture(GL_TEXTURE_CUBE_MAP, self.cubemapTexture)
             glUniform1i(self.cubemapTextureHandle, 2)
-         
-        glBindVertexArray(self.VAO)
-        
-        # Translate Y 
-        self.modelMatrix[13] = self.offset.y        
-                    
-        for i in range(self.tileCount.x):
-            # Translate X
-            self.modelMatrix[12] =  self.offset.x + \
-                                    self.tileSize * self.scale * i
-            for j in range(self.tileCount.y):
-                # Translate Z
-                self.modelMatrix[14] =  self.offset.z + \
-                                        self.tileSize * self.scale * j 
-                glUniform2fv(self.tileOffsetHandle, 2, (c_float*2)(*[i, j]))        
-                glUniformMatrix4fv( self.modelMatrixHandle,
-                                    1,
-                                    False,
-                                    self.modelMatrix.elements)
-                glDrawElements(GL_TRIANGLES,self.vertexCount,GL_UNSIGNED_INT, 0)        
+            
+        if self.displacement:
+            glActiveTexture(GL_TEXTURE3)
+            glBindTexture(GL_TEXTURE_2D, self.heightfield.getTexture().id)
+            glUniform1i(self.heightsHandle, 3)
+            
+        if self.projected:
+            self.drawProjectedGrid()
+        else:
+            self.drawTiles()
 
         glBindTexture(GL_TEXTURE_2D, 0)        
         glBindTexture(GL_TEXTURE_CUBE_MAP, 0)   
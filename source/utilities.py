@@ -69,6 +69,36 @@ def gaussianRandomVariable():
     res = complex(x1 * w, x2 * w) 
     return res 
 
+class DirtyFlags():
+    '''
+    Tracks which derived products of a scene are out of date.
+    
+    dependencies maps each product to the inputs or products it is derived
+    from. Invalidating a name marks it and everything derived from it, directly
+    or indirectly, as dirty; a product is marked clean once it has been
+    regenerated. Every product starts dirty.
+    '''
+    def __init__(self, dependencies):
+        self.dependents = {}
+        for product, inputs in dependencies.items():
+            self.dependents.setdefault(product, set())
+            for name in inputs:
+                self.dependents.setdefault(name, set()).add(product)
+        self.dirty = set(self.dependents)
+        
+    def invalidate(self, name):
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            self.dirty.add(name)
+            pending.extend(self.dependents[name] - self.dirty)
+            
+    def isDirty(self, name):
+        return name in self.dirty
+        
+    def clean(self, name):
+        self.dirty.discard(name)
+
 def fullscreenQuad():
     '''
     Generate vertices and indices for drawing a fullscreen quad.
@@ -101,7 +131,60 @@ def fullscreenQuad():
         
     
     return vertices, indices, vertexSize
-    
+
+def fullscreenQuadVAO(positionHandle, texcoordHandle):
+    '''
+    Upload a fullscreen quad into a vertex array object so that it can be drawn
+    repeatedly without re-specifying its buffers.
+
+    Returns the VAO and the number of GL_UNSIGNED_SHORT indices to draw with
+    glDrawElements(GL_TRIANGLES, count, GL_UNSIGNED_SHORT, 0).
+    '''
+    vertices, indices, vertexSize = fullscreenQuad()
+
+    VAO = GLuint()
+    glGenVertexArrays(1, ctypes.pointer(VAO))
+    glBindVertexArray(VAO)
+
+    # Vertex Buffer Objects (Positions Texcoords and Indices)
+    vertVBO = GLuint()
+    indexVBO = GLuint()
+    glGenBuffers(1, ctypes.pointer(vertVBO))
+    glGenBuffers(1, ctypes.pointer(indexVBO))
+
+    glBindBuffer(GL_ARRAY_BUFFER, vertVBO)
+    glBufferData(   GL_ARRAY_BUFFER,
+                    ctypes.sizeof(vertices),
+                    vertices,
+                    GL_STATIC_DRAW)
+    # Positions
+    glEnableVertexAttribArray(positionHandle)
+    glVertexAttribPointer(  positionHandle,
+                            3,
+                            GL_FLOAT,
+                            GL_FALSE,
+                            vertexSize,
+                            0)
+    # TexCoords
+    if texcoordHandle >= 0:
+        glEnableVertexAttribArray(texcoordHandle)
+        glVertexAttribPointer(  texcoordHandle,
+                                2,
+                                GL_FLOAT,
+                                GL_FALSE,
+                                vertexSize,
+                                ctypes.sizeof(GLfloat) * 3)
+    # Indices
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, indexVBO)
+    glBufferData(   GL_ELEMENT_ARRAY_BUFFER,
+                    ctypes.sizeof(indices),
+                    indices,
+                    GL_STATIC_DRAW)
+
+    glBindVertexArray(0)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    return VAO, len(indices)
+
 def SkyboxVerts():
     '''
     Generate vertices and indices for drawing a skybox
@@ -235,4 +318,68 @@ def Mesh2DSurface(dimension=64, scale=1.0):
             verts[i][j][6] = i/float(N)
             # # Texture Y                        
             verts[i][j][7] = j/float(N)  
-    return verts, indices
\ No newline at end of file
+    return verts, indices
+
+def Mesh2DSurfaceLOD(dimension=64, step=2, coarse=(False, False, False, False)):
+    '''
+    Generate the indices of a reduced detail version of the NxN surface mesh
+    from Mesh2DSurface, using every step'th vertex of the same vertex grid.
+    
+    Quads along the border are replaced by strips that join the inner grid to
+    the edge vertices. An edge flagged in coarse (X-, X+, Z-, Z+) only uses
+    every 2*step'th vertex, matching a neighbouring tile one level coarser so
+    no cracks open along the seam.
+    
+        +---------------+   Inner quads at 1/step density
+        |\ /|\ /|\ /|\ /|   
+        |-+---+---+---+-|   Border strips fan between the inner grid
+        | |   |   |   | |   and the (possibly coarser) edge vertices
+    '''
+    N = dimension
+    N1 = N + 1
+    s = step
+    
+    # Inner quads, two triangles each
+    x, z = np.meshgrid(np.arange(s, N - s, s), np.arange(s, N - s, s))
+    a = (z * N1 + x).ravel()
+    b = a + s * N1
+    c = a + s
+    d = b + s
+    triangles = [np.column_stack((a, b, c)), np.column_stack((c, b, d))]
+    
+    # Border strips. Each edge is a line of outer points along the edge and
+    # a line of inner points along the inner grid, as (x, z) at distance t
+    edges = [(lambda t: (0, t),     lambda t: (s, t)),      # X-
+             (lambda t: (N, t),     lambda t: (N - s, t)),  # X+
+             (lambda t: (t, 0),     lambda t: (t, s)),      # Z-
+             (lambda t: (t, N),     lambda t: (t, N - s))]  # Z+
+    for (outerPoint, innerPoint), isCoarse in zip(edges, coarse):
+        outer = range(0, N + 1, 2 * s if isCoarse else s)
+        inner = range(s, N - s + 1, s)
+        # Zip the two lines together, always advancing along the line whose
+        # next point is nearest the start of the edge
+        strip = []
+        o, n = 0, 0
+        while o < len(outer) - 1 or n < len(inner) - 1:
+            if n == len(inner) - 1 or (o < len(outer) - 1 and
+                                       outer[o + 1] <= inner[n + 1]):
+                strip.append((  outerPoint(outer[o]),
+                                outerPoint(outer[o + 1]),
+                                innerPoint(inner[n])))
+                o += 1
+            else:
+                strip.append((  outerPoint(outer[o]),
+                                innerPoint(inner[n + 1]),
+                                innerPoint(inner[n])))
+                n += 1
+        strip = np.array(strip)
+        triangles.append(strip[...,1] * N1 + strip[...,0])
+    triangles = np.concatenate(triangles)
+    
+    # Wind all triangles the same way as Mesh2DSurface, facing +Y
+    x, z = triangles % N1, triangles // N1
+    facing = (z[:,1] - z[:,0]) * (x[:,2] - x[:,0]) - \
+             (x[:,1] - x[:,0]) * (z[:,2] - z[:,0])
+    flip = facing < 0
+    triangles[flip] = triangles[flip][:,::-1]
+    return triangles.astype('u4').ravel()
@@ -1,15 +1,40 @@
 from heightfields import Tessendorf, Ripples
 from surface import Surface
-from caustics import Caustics
+from caustics import Caustics, CausticArray
 
 from pyglet import *
 from pyglet.gl import *
 
 from vector import Vector2, Vector3
+from utilities import DirtyFlags
 
 import shader
+import glob
+import os
 
 class Ocean():
+    '''
+    A tiled ocean surface generated with Tessendorf's FFT synthesis over a
+    floor lit by caustics.
+    
+    By default the caustics are regenerated as the surface moves (see
+    Caustics). Setting causticLayers bakes one period of caustics into that
+    many layers of a texture array at start up instead, or causticFrames may
+    name a directory of frame_*.png images (saved with main.py --grab) to load
+    the layers from. The caustics then cost no photon passes at run time but
+    are fixed, they are only rebaked when the heightfield is rebuilt.
+    
+    With instancedTiles set the surface and floor tiles are each drawn with a
+    single instanced draw call rather than one draw call per tile. With
+    cullTiles set tiles outside the view frustum are not drawn. With
+    followCamera set the tiles are centred on the camera and scroll with it.
+    Distant surface tiles are drawn with up to lodLevels levels of reduced
+    detail. With projectedGrid set the surface is instead drawn as a screen
+    space grid projected onto the water. With compactVertices set the
+    surface vertices are streamed in a 12 byte format (see Surface). With
+    gpuDisplacement set only the heightfield's displacement texture is
+    uploaded and the surface and caustics displace static grids on the GPU.
+    '''
     def __init__(   self,
                     camera,
                     cubemap=None,
@@ -22,7 +47,22 @@ class Ocean():
                     wind=Vector2(64.0,128.0),
                     period=10.0,
                     photonScale=4.0,
-                    photonIntensity=2.0):
+                    photonIntensity=2.0,
+                    causticCacheSize=0,
+                    causticLayers=0,
+                    causticFrames=None,
+                    photonGrid=0,
+                    causticTriangles=False,
+                    causticLaplacian=False,
+                    causticResolution=1,
+                    causticSpectral=False,
+                    instancedTiles=False,
+                    cullTiles=False,
+                    followCamera=False,
+                    lodLevels=1,
+                    projectedGrid=False,
+                    compactVertices=False,
+                    gpuDisplacement=False):
                     
                     
         if cubemap:
@@ -39,6 +79,8 @@ class Ocean():
         self.enableCaustics = True
         self.photonIntensity = photonIntensity
         self.photonScale = photonScale
+        self.causticLaplacian = causticLaplacian
+        self.gpuDisplacement = gpuDisplacement
         
         self.tileSize = tileSize
         self.tilesX = tilesX
@@ -47,10 +89,41 @@ class Ocean():
         self.camera = camera
         self.scale = scale
 
+        self.time = 0.0
+        
+        # Products which are only regenerated when their inputs change
+        self.state = DirtyFlags({
+                        'vertices':  ['time', 'heightfield'],
+                        'photonMap': ['vertices', 'depth', 'photons']})
+        
+        # Baked caustics
+        if causticFrames:
+            self.causticFrames = sorted(glob.glob(
+                                    os.path.join(causticFrames, 'frame_*.png')))
+            causticLayers = len(self.causticFrames)
+        else:
+            self.causticFrames = None
+        if causticLayers:
+            self.causticArray = CausticArray(self.tileSize, causticLayers)
+            self.shaderDefines = ['CAUSTIC_ARRAY']
+        else:
+            self.causticArray = None
+            self.shaderDefines = []
+        if instancedTiles:
+            self.shaderDefines.append('INSTANCED_TILES')
+        if projectedGrid:
+            self.shaderDefines.append('PROJECTED_GRID')
+        if compactVertices:
+            self.shaderDefines.append('COMPACT_VERTICES')
+        if gpuDisplacement:
+            self.shaderDefines.append('TESSENDORF_DISPLACEMENT')
+
         self.surfaceShader = shader.openfiles(  'shaders/ocean.vertex',
-                                                'shaders/ocean.fragment')
+                                                'shaders/ocean.fragment',
+                                                self.shaderDefines)
         self.groundShader = shader.openfiles(   'shaders/oceanfloor.vertex',
-                                                'shaders/oceanfloor.fragment')
+                                                'shaders/oceanfloor.fragment',
+                                                self.shaderDefines)
 
         self.oceanFloorTexture = image.load('images/tiles.png').get_texture() 
         
@@ -60,26 +133,39 @@ class Ocean():
                                                             self.tileSize, 
                                                             self.tileSize,
                                                             GL_RGBA)
+        if self.causticArray:
+            surfaceCaustics = self.causticArray
+        else:
+            surfaceCaustics = self.causticTexture
         
         # Use Tessendorf FFT synthesis to create a convincing ocean surface.
         self.heightfield = Tessendorf(  self.tileSize,
                                         self.waveHeight, 
                                         self.wind,
                                         self.length,
-                                        self.period)
+                                        self.period,
+                                        self.causticLaplacian,
+                                        self.gpuDisplacement)
                                            
         # The water surface
         self.surface = Surface( self.surfaceShader,
                                 self.camera,
                                 texture=self.oceanFloorTexture,
-                                causticTexture=self.causticTexture,
+                                causticTexture=surfaceCaustics,
                                 cubemapTexture=self.cubemapTexture,
                                 heightfield=self.heightfield,
                                 tileSize=self.tileSize, 
                                 tilesX=self.tilesX,
                                 tilesZ=self.tilesZ,
                                 scale=self.scale, 
-                                offset=Vector3(0.0,self.oceanDepth,0.0))
+                                offset=Vector3(0.0,self.oceanDepth,0.0),
+                                instanced=instancedTiles,
+                                cull=cullTiles,
+                                follow=followCamera,
+                                lodLevels=lodLevels,
+                                projected=projectedGrid,
+                                compact=compactVertices,
+                                displacement=gpuDisplacement)
                                 
         # The caustics engine, uses the water surface to generate a caustic tex                      
         self.caustics = Caustics (  self.camera,
@@ -88,19 +174,34 @@ class Ocean():
                                     self.causticTexture,
                                     self.photonScale,
                                     self.photonIntensity,
+                                    self.period,
+                                    causticCacheSize,
+                                    photonGrid=photonGrid,
+                                    triangles=causticTriangles,
+                                    analytic=causticLaplacian,
+                                    resolution=causticResolution,
+                                    spectral=causticSpectral,
                                  )
         
         # The sea bed, an undisturbed mesh
         self.ground = Surface( self.groundShader,
                                 self.camera,
                                 texture=self.oceanFloorTexture,
-                                causticTexture=self.causticTexture,
+                                causticTexture=surfaceCaustics,
                                 heightfield=None,
                                 tileSize=1, 
                                 tilesX=self.tilesX,
                                 tilesZ=self.tilesZ,
                                 scale=self.scale * self.tileSize, 
-                                offset=Vector3(0.0,0.0,0.0))
+                                offset=Vector3(0.0,0.0,0.0),
+                                instanced=instancedTiles,
+                                cull=cullTiles,
+                                follow=followCamera)
+        
+        if self.causticFrames:
+            self.causticArray.load(self.causticFrames)
+        elif self.causticArray:
+            self.causticArray.bake(self.caustics, self.period)
                                 
     def reloadShaders(self):
         from shader import FragmentShader, ShaderError, ShaderProgram, VertexShader
@@ -114,17 +215,17 @@ class Ocean():
             return src
             
         fsrc = read_source('shaders/ocean.fragment')
-        fshader = FragmentShader([fsrc])
+        fshader = FragmentShader([shader.preprocess(fsrc, self.shaderDefines)])
         vsrc = read_source('shaders/ocean.vertex')
-        vshader = VertexShader([vsrc])
+        vshader = VertexShader([shader.preprocess(vsrc, self.shaderDefines)])
 
         self.surfaceShader = ShaderProgram(fshader, vshader)
         self.surfaceShader.use()
         
         fsrc = read_source('shaders/oceanfloor.fragment')
-        fshader = FragmentShader([fsrc])
+        fshader = FragmentShader([shader.preprocess(fsrc, self.shaderDefines)])
         vsrc = read_source('shaders/oceanfloor.vertex')
-        vshader = VertexShader([vsrc])
+        vshader = VertexShader([shader.preprocess(vsrc, self.shaderDefines)])
 
         self.groundShader = ShaderProgram(fshader, vshader)
         self.groundShader.use()
@@ -135,14 +236,20 @@ class Ocean():
     def setCausticPhotonIntensity(self, intensity):
         self.photonIntensity = intensity
         self.caustics.photonIntensity = self.photonIntensity
+        self.state.invalidate('photons')
     def setCausticPhotonScale(self, scale):
         self.photonScale = scale
         self.caustics.photonScale = self.photonScale
+        self.state.invalidate('photons')
+    def setCausticResolution(self, resolution):
+        self.caustics.setResolution(resolution)
+        self.state.invalidate('photons')
                                 
     def setDepth(self, depth):
         self.oceanDepth = depth
         self.caustics.setDepth(self.oceanDepth)
         self.surface.setDepth(self.oceanDepth)
+        self.state.invalidate('depth')
     
     def resetHeightfield(self):
         '''
@@ -155,8 +262,14 @@ class Ocean():
                                         self.waveHeight, 
                                         self.wind,
                                         self.length,
-                                        self.period)
+                                        self.period,
+                                        self.causticLaplacian,
+                                        self.gpuDisplacement)
         self.surface.setHeightfield( self.heightfield)   
+        self.caustics.clearCache()
+        self.state.invalidate('heightfield')
+        if self.causticArray and not self.causticFrames:
+            self.causticArray.bake(self.caustics, self.period)
         
     def setWind(self, wind):
         self.wind = wind      
@@ -166,16 +279,40 @@ class Ocean():
         self.resetHeightfield()  
 
     def draw(self,dt):
+        '''
+        Draw the ocean, regenerating only the products whose inputs have
+        changed. Nothing is regenerated while the animation is paused (dt is
+        zero) unless a parameter has been changed.
+        '''
+        if dt > 0.0:
+            self.time += dt
+            self.state.invalidate('time')
+        if self.causticArray:
+            self.causticArray.setTime(self.time, self.period)
+        caustics = self.drawSeaFloor and self.enableCaustics and \
+                   not self.causticArray
+                   
+        # The vertices are needed to draw the surface and the photon map. The
+        # surface catches up on any time that passed while it was hidden.
+        if self.state.isDirty('vertices') and (self.drawSeaSurface or caustics):
+            self.surface.update(self.time - self.surface.time, force=True)
+            self.state.clean('vertices')
+            
         if self.drawSeaSurface:
-            self.surface.draw(dt)
+            self.surface.draw(0.0)
         if self.drawSeaFloor:
-            if self.enableCaustics:
+            if caustics and self.state.isDirty('photonMap'):
                 self.caustics.update(dt)
+                self.state.clean('photonMap')
             self.ground.draw(dt)
         
 class Pool():
     '''
     A shallow pool with concentric ripples on its surface
+    
+    The ripple heights stay on the GPU, the surface vertex shader samples the
+    automaton's texture directly. Set cpuReadback to also read the heights back
+    into the surface vertices, e.g. for gameplay queries.
     '''
     def __init__(   self,
                     camera,
@@ -183,7 +320,8 @@ class Pool():
                     tileSize=128,
                     tilesX=1,
                     tilesZ=1,
-                    depth=30.0):
+                    depth=30.0,
+                    cpuReadback=False):
     
         self.depth = depth
 
@@ -194,11 +332,18 @@ class Pool():
         self.camera = camera
         self.scale = scale
         
-        self.surfaceShader = ShaderProgram.open('shaders/colour_by_height.shader')
-
-        
         # Use the shallow pool ripple surface generator
-        self.heightfield = Ripples(self.camera, self.tileSize)
+        self.heightfield = Ripples( self.camera,
+                                    self.tileSize,
+                                    cpuReadback=cpuReadback)
+        
+        # The surface shader decodes heights in the automaton's format
+        defines = ['RIPPLE_DISPLACEMENT']
+        if self.heightfield.floatHeights:
+            defines.append('FLOAT_HEIGHTS')
+        self.surfaceShader = shader.openfiles(  'shaders/ocean.vertex',
+                                                'shaders/ocean.fragment',
+                                                defines)
                                            
         # The water surface
         self.surface = Surface( self.surfaceShader,
@@ -209,7 +354,8 @@ class Pool():
                                 tilesX=self.tilesX,
                                 tilesZ=self.tilesZ,
                                 scale=self.scale, 
-                                offset=Vector3(0.0,self.depth,0.0))
+                                offset=Vector3(0.0,self.depth,0.0),
+                                displacement=True)
 
     def setDepth(self, depth):
         self.surface.setDepth(self.depth)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from headless import CausticsCPU, laplacianCaustics
+
+N = 128
+kDepth = 55.0
+
+def waves(amplitude, seed=0):
+    '''
+    A periodic N x N surface made of a few cosine waves. Returns the surface
+    vertices and triangle indices in the layout of Surface, and the exact
+    laplacian of the heights.
+    '''
+    random = np.random.RandomState(seed)
+    z, x = np.mgrid[0:N + 1, 0:N + 1].astype(np.float64)
+    h, hx, hz, laplacian = [np.zeros_like(x) for i in range(4)]
+    for i in range(8):
+        m, n = random.randint(1, 6), random.randint(-5, 6)
+        kx, kz = 2.0 * np.pi * m / N, 2.0 * np.pi * n / N
+        a = amplitude / np.sqrt(m * m + n * n)
+        phase = kx * x + kz * z + random.uniform(0.0, 2.0 * np.pi)
+        h += a * np.cos(phase)
+        hx -= a * kx * np.sin(phase)
+        hz -= a * kz * np.sin(phase)
+        laplacian -= a * (kx * kx + kz * kz) * np.cos(phase)
+    verts = np.stack([x, h, z, -hx, np.ones_like(x), -hz], -1)
+    quads = np.arange((N + 1) * (N + 1)).reshape(N + 1, N + 1)[:-1, :-1]
+    indices = np.stack([quads, quads + N + 1, quads + 1,
+                        quads + 1, quads + N + 1, quads + N + 2], -1)
+    return verts.astype(np.float32), indices.ravel(), \
+           laplacian[:-1, :-1].astype(np.float32)
+
+def blur(photonMap, radius=2):
+    '''
+    Box filter the photon map to remove the noise of the individual photons.
+    '''
+    result = np.zeros_like(photonMap)
+    for dz in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            result += np.roll(np.roll(photonMap, dz, 0), dx, 1)
+    return result / (2 * radius + 1) ** 2
+
+@pytest.mark.parametrize('amplitude', [0.2, 1.0])
+def test_laplacian_caustics_match_photon_map(amplitude):
+    '''
+    The analytic caustics should have the brightness and contrast of the
+    photon map, both before the focus (amplitude 0.2) and past it, at the
+    curvature of the default scene (amplitude 1.0).
+    '''
+    verts, indices, laplacian = waves(amplitude)
+    photons = blur(CausticsCPU(N, kDepth, 2.0, 2.0).update(verts, indices))
+    analytic = laplacianCaustics(laplacian, kDepth, 2.0, 2.0)
+    
+    assert abs(analytic.mean() - photons.mean()) < 0.1 * photons.mean()
+    spread = np.percentile(analytic, 95) - np.percentile(analytic, 5)
+    photonSpread = np.percentile(photons, 95) - np.percentile(photons, 5)
+    assert 0.5 < spread / photonSpread < 2.0
+    assert np.corrcoef(analytic.ravel(), photons.ravel())[0, 1] > 0.5
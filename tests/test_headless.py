@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from headless import RipplesCPU, kBlockSize
+from vector import Vector2
+
+@pytest.mark.parametrize('substeps', [1, 3, 4, 8, kBlockSize])
+@pytest.mark.parametrize('taps', [((40, 40),),
+                                  ((40, 40), (90, 20), (64, 100)),
+                                  ((1, 1), (126, 64))])
+def test_sparse_matches_dense(substeps, taps):
+    '''
+    A sparse simulation steps only the active blocks, it must give exactly
+    the same heights as stepping the whole automaton.
+    '''
+    N = 128
+    dense = RipplesCPU(N, substeps=substeps)
+    sparse = RipplesCPU(N, substeps=substeps, blockSize=kBlockSize)
+    verts = np.zeros((N + 1, N + 1, 6), np.float32)
+    for x, y in taps:
+        dense.tap(Vector2(x, y))
+        sparse.tap(Vector2(x, y))
+    for i in range(60):
+        dense.update(i, verts, None)
+        sparse.update(i, verts, None)
+        assert np.array_equal(dense.getHeights(), sparse.getHeights())